@@ -0,0 +1,123 @@
+import hashlib
+import os
+import sqlite3
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import instrumentation
+
+# Value of `AnnotationType.SPOT` in SlideRunner databases.
+SPOT_ANNOTATION_TYPE = 1
+
+_QUERY = '''
+    SELECT a.uid, a.slide, COALESCE(a.agreedClass, 0), c.coordinateX, c.coordinateY, MIN(c.orderIdx)
+    FROM Annotations a
+    JOIN Annotations_coordinates c ON c.annoId = a.uid
+    WHERE COALESCE(a.deleted, 0) = 0 AND a.type = ?
+    GROUP BY a.uid
+    ORDER BY a.slide, a.uid
+'''
+
+
+class AnnotationTable:
+    """SPOT annotations of every slide in a SlideRunner database, sorted by slide."""
+
+    def __init__(self,
+                 slides: List[Tuple[int, str]],
+                 uids: np.ndarray,
+                 slide_ids: np.ndarray,
+                 classes: np.ndarray,
+                 x: np.ndarray,
+                 y: np.ndarray):
+        self.slides = slides
+        self.uids = uids
+        self.slide_ids = slide_ids
+        self.classes = classes
+        self.x = x
+        self.y = y
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def for_slide(self, slide_id: int) -> 'AnnotationTable':
+        # Rows are sorted by slide, so each slide is a contiguous slice (a view).
+        start, end = np.searchsorted(self.slide_ids, [slide_id, slide_id + 1])
+        filenames = [s for s in self.slides if s[0] == slide_id]
+        return AnnotationTable(filenames,
+                               self.uids[start:end],
+                               self.slide_ids[start:end],
+                               self.classes[start:end],
+                               self.x[start:end],
+                               self.y[start:end])
+
+    def save(self, path: str) -> None:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     slide_uids=np.array([s[0] for s in self.slides], dtype=np.int64),
+                     slide_filenames=np.array([s[1] for s in self.slides], dtype=str),
+                     uids=self.uids,
+                     slide_ids=self.slide_ids,
+                     classes=self.classes,
+                     x=self.x,
+                     y=self.y)
+
+        # Only expose complete files under the final name.
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'AnnotationTable':
+        with np.load(path) as data:
+            slides = list(zip(data['slide_uids'].tolist(), data['slide_filenames'].tolist()))
+            return cls(slides, data['uids'], data['slide_ids'], data['classes'], data['x'], data['y'])
+
+    @classmethod
+    def from_database(cls, database_path: str) -> 'AnnotationTable':
+        connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+        try:
+            with instrumentation.timer('annotations.query'):
+                slides = [(int(uid), filename) for uid, filename in
+                          connection.execute('SELECT uid, filename FROM Slides ORDER BY uid').fetchall()]
+                rows = np.array(connection.execute(_QUERY, (SPOT_ANNOTATION_TYPE,)).fetchall(),
+                                dtype=np.float64).reshape(-1, 6)
+        finally:
+            connection.close()
+
+        return cls(slides,
+                   uids=rows[:, 0].astype(np.int64),
+                   slide_ids=rows[:, 1].astype(np.int64),
+                   classes=rows[:, 2].astype(np.int32),
+                   x=rows[:, 3],
+                   y=rows[:, 4])
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(65536), b''):
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+def load_annotations(database_path: str,
+                     sha256: Optional[str] = None,
+                     cache_dir: Optional[str] = None) -> AnnotationTable:
+
+    if sha256 is None:
+        sha256 = file_sha256(database_path)
+
+    cache_dir = os.path.dirname(database_path) if cache_dir is None else cache_dir
+    os.makedirs(cache_dir or '.', exist_ok=True)
+
+    # The cache is keyed by the database contents, so a different or updated
+    # database never picks up stale annotations.
+    cache_path = os.path.join(cache_dir, f'{os.path.basename(database_path)}.{sha256}.npz')
+    if os.path.exists(cache_path):
+        return AnnotationTable.load(cache_path)
+
+    table = AnnotationTable.from_database(database_path)
+    table.save(cache_path)
+
+    return table
@@ -0,0 +1,256 @@
+"""Offline benchmarks for the data and inference paths, on synthetic slides.
+
+    python benchmark.py --output results.json
+
+Every benchmark reports its throughput and per-item latency percentiles, and
+the whole run is written as one JSON document so that runs can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import openslide
+
+from annotation_loader import AnnotationTable, load_annotations
+from export import ExportJob, export_patches, slide_specs
+import instrumentation
+from inference import StubRekognitionClient, enumerate_tiles, iter_tile_detections, merge_detections
+from manifest import ManifestWriter
+from sampling import get_slides, set_tile_cache_budget, tile_cache
+from slidepool import handle_pool
+from synthetic import dark_spot_detector, make_dataset
+
+
+def summarize(latencies: Sequence[float], seconds: float, items: int, unit: str, **extra) -> Dict[str, Any]:
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    result = {
+        'items': items,
+        'unit': unit,
+        'seconds': seconds,
+        'throughput': items / seconds if seconds > 0 else 0.0,
+    }
+    if len(latencies_ms):
+        p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+        result.update(mean_ms=float(latencies_ms.mean()), p50_ms=float(p50), p90_ms=float(p90),
+                      p99_ms=float(p99), max_ms=float(latencies_ms.max()))
+    result.update(extra)
+    return result
+
+
+def _timed(fn: Callable[[], Any], repeats: int) -> Tuple[List[float], Any]:
+    latencies, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+def bench_annotation_loading(database_path: str, repeats: int = 5) -> Dict[str, Any]:
+    # Cold: the SQL query against the database. Warm: the checksummed npz cache.
+    cold, table = _timed(lambda: AnnotationTable.from_database(database_path), repeats)
+
+    cache_dir = tempfile.mkdtemp(prefix='annotations-')
+    load_annotations(database_path, cache_dir=cache_dir)
+    warm, _ = _timed(lambda: load_annotations(database_path, cache_dir=cache_dir), repeats)
+
+    count = len(table)
+    return {
+        'cold': summarize(cold, sum(cold), count * repeats, 'annotations'),
+        'warm': summarize(warm, sum(warm), count * repeats, 'annotations'),
+    }
+
+
+def bench_get_slides(table: AnnotationTable, base_path: str, size: int, repeats: int = 3) -> Dict[str, Any]:
+    latencies, _ = _timed(lambda: get_slides(None, [], base_path=base_path, size=size, annotation_table=table),
+                          repeats)
+    return summarize(latencies, sum(latencies), len(table.slides) * repeats, 'slides')
+
+
+def _random_windows(files, count: int, size: int, seed: int) -> List[tuple]:
+    rng = np.random.default_rng(seed)
+    windows = []
+    for _ in range(count):
+        slide_idx = int(rng.integers(len(files)))
+        width, height = files[slide_idx].metadata.level_dimensions[files[slide_idx].level]
+        windows.append((slide_idx, int(rng.integers(0, width - size)), int(rng.integers(0, height - size))))
+    return windows
+
+
+def bench_patch_reads(files, count: int, size: int, seed: int = 0, cache_bytes: int = 512 * 1024 * 1024) -> Dict[str, Any]:
+    windows = _random_windows(files, count, size, seed)
+
+    def run() -> List[float]:
+        latencies = []
+        for slide_idx, x, y in windows:
+            start = time.perf_counter()
+            files[slide_idx].get_patch(x, y)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results = {}
+    # Uncached reads go straight to OpenSlide; cached reads are measured on a
+    # second pass over the same windows, once the tile cache is warm.
+    set_tile_cache_budget(0)
+    handle_pool.clear()
+    latencies = run()
+    results['uncached'] = summarize(latencies, sum(latencies), count, 'patches')
+
+    set_tile_cache_budget(cache_bytes)
+    tile_cache.clear()
+    latencies = run()
+    results['cache_cold'] = summarize(latencies, sum(latencies), count, 'patches')
+    latencies = run()
+    results['cache_warm'] = summarize(latencies, sum(latencies), count, 'patches', cache=tile_cache.stats)
+
+    return results
+
+
+def bench_export(files, lbl_bbox, output_dir: str, count: int, size: int, max_workers: Optional[int],
+                 seed: int = 0) -> Dict[str, Any]:
+    jobs = [ExportJob(slide_idx, x, y, 'train') for slide_idx, x, y in _random_windows(files, count, size, seed)]
+    specs = slide_specs(files, lbl_bbox)
+
+    manifest_path = os.path.join(output_dir, 'train.manifest')
+    with ManifestWriter(manifest_path, 'benchmark', 'train', size, class_map={1: 'mitotic figure'}) as manifest:
+        start = time.perf_counter()
+        written = export_patches(jobs, specs, {'train': manifest}, output_dir=output_dir, size=size,
+                                 max_workers=max_workers)
+        seconds = time.perf_counter() - start
+
+    # Export runs in worker processes, so only its total time is measured.
+    return summarize([], seconds, written, 'patches', workers=max_workers or os.cpu_count())
+
+
+class _TimedClient:
+
+    def __init__(self, client, latency: float):
+        self.client = client
+        self.latency = latency
+        self.latencies = []
+
+    def detect_custom_labels(self, **kwargs):
+        start = time.perf_counter()
+        # Simulated network and model time, on top of the stub's own decoding.
+        time.sleep(self.latency)
+        response = self.client.detect_custom_labels(**kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+
+def bench_inference(container, latency: float, max_workers: int, tile_size: int = 512, overlap: int = 64,
+                    max_tiles: Optional[int] = None) -> Dict[str, Any]:
+    client = _TimedClient(StubRekognitionClient(dark_spot_detector), latency)
+
+    width, height = container.metadata.level_dimensions[container.level]
+    tiles = enumerate_tiles(width, height, tile_size, overlap)[:max_tiles]
+
+    start = time.perf_counter()
+    detections = [d for result in iter_tile_detections(container, client, 'synthetic', tile_size=tile_size,
+                                                       overlap=overlap, max_workers=max_workers, tiles=tiles)
+                  for d in result.detections]
+    merged = merge_detections(detections)
+    seconds = time.perf_counter() - start
+
+    return summarize(client.latencies, seconds, len(tiles), 'tiles', workers=max_workers,
+                     simulated_latency_ms=latency * 1000, detections=len(detections), merged=len(merged))
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'openslide': getattr(openslide, '__library_version__', None),
+    }
+
+
+def run(work_dir: str,
+        slides: int = 2,
+        slide_size: int = 8192,
+        annotations: int = 500,
+        patch_size: int = 512,
+        reads: int = 500,
+        exports: int = 200,
+        workers: Optional[int] = None,
+        latency: float = 0.02,
+        max_tiles: Optional[int] = None,
+        seed: int = 0) -> Dict[str, Any]:
+
+    config = dict(slides=slides, slide_size=slide_size, annotations=annotations, patch_size=patch_size,
+                  reads=reads, exports=exports, workers=workers, latency=latency, max_tiles=max_tiles, seed=seed)
+
+    # Slides are only written once per work directory and configuration, as
+    # generating them dominates everything else.
+    data_dir = os.path.join(work_dir, f'synthetic_{slides}x{slide_size}_{annotations}_{seed}')
+    database_path, _ = make_dataset(data_dir, slide_count=slides, width=slide_size, height=slide_size,
+                                    annotations_per_slide=annotations, seed=seed)
+
+    results = {'annotation_loading': bench_annotation_loading(database_path)}
+
+    table = AnnotationTable.from_database(database_path)
+    results['get_slides'] = bench_get_slides(table, data_dir, patch_size)
+    lbl_bbox, _, _, files = get_slides(None, [], base_path=data_dir, size=patch_size, annotation_table=table)
+
+    results['patch_reads'] = bench_patch_reads(files, reads, patch_size, seed=seed)
+    results['export'] = bench_export(files, lbl_bbox, tempfile.mkdtemp(prefix='export-', dir=work_dir),
+                                     exports, patch_size, workers, seed=seed)
+    results['inference'] = bench_inference(files[0], latency, workers or 8, tile_size=patch_size,
+                                           max_tiles=max_tiles)
+
+    return {'environment': environment(), 'config': config, 'results': results}
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'rek-benchmark'),
+                        help='where synthetic slides and exports are written')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--slides', type=int, default=2)
+    parser.add_argument('--slide-size', type=int, default=8192, help='width and height of level 0, in pixels')
+    parser.add_argument('--annotations', type=int, default=500, help='annotations per slide')
+    parser.add_argument('--patch-size', type=int, default=512)
+    parser.add_argument('--reads', type=int, default=500, help='random patch reads per pass')
+    parser.add_argument('--exports', type=int, default=200, help='patches to export')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated detector latency, in seconds')
+    parser.add_argument('--max-tiles', type=int, default=None, help='limit the tiles used for inference')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='also record per-stage timings, and write a Chrome trace to this file')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    if args.trace:
+        instrumentation.enable(trace=True)
+    report = run(args.work_dir,
+                 slides=args.slides,
+                 slide_size=args.slide_size,
+                 annotations=args.annotations,
+                 patch_size=args.patch_size,
+                 reads=args.reads,
+                 exports=args.exports,
+                 workers=args.workers,
+                 latency=args.latency,
+                 max_tiles=args.max_tiles,
+                 seed=args.seed)
+    if args.trace:
+        report['stages'] = instrumentation.summary()
+        instrumentation.write_trace(args.trace)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+class BoundingBox:
+
+    def __init__(self, left: int, top: int, right: int, bottom: int):
+        self._left = left
+        self._top = top
+        self._right = right
+        self._bottom = bottom
+
+    @property
+    def left(self) -> int:
+        return self._left
+
+    @property
+    def top(self) -> int:
+        return self._top
+
+    @property
+    def right(self) -> int:
+        return self._right
+
+    @property
+    def bottom(self) -> int:
+        return self._bottom
+
+    def check_bbox(self, x_start: int, y_start: int, size: int = 512) -> bool:
+        return (self._left > x_start and
+                self._right < x_start + size and
+                self._top > y_start and
+                self._bottom < y_start + size)
+
+
+class BoxArray:
+    """Struct-of-arrays collection of bounding boxes with one label per box."""
+
+    def __init__(self, left, top, right, bottom, labels=None):
+        self.left = np.asarray(left, dtype=np.int32)
+        self.top = np.asarray(top, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.bottom = np.asarray(bottom, dtype=np.int32)
+        self.labels = (np.zeros(len(self.left), dtype=np.int32) if labels is None
+                       else np.asarray(labels, dtype=np.int32))
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence[int]], labels: Optional[Sequence[int]] = None) -> 'BoxArray':
+        rows = np.asarray(rows, dtype=np.int32).reshape(-1, 4)
+        return cls(rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], labels)
+
+    @classmethod
+    def empty(cls) -> 'BoxArray':
+        return cls.from_rows([])
+
+    def __len__(self) -> int:
+        return len(self.left)
+
+    def __getitem__(self, key) -> Union[BoundingBox, 'BoxArray']:
+        if np.isscalar(key):
+            return BoundingBox(int(self.left[key]), int(self.top[key]), int(self.right[key]), int(self.bottom[key]))
+
+        # Slices give views into the same columns; masks and index arrays copy.
+        return BoxArray(self.left[key], self.top[key], self.right[key], self.bottom[key], self.labels[key])
+
+    def __iter__(self) -> Iterator[BoundingBox]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.right - self.left
+
+    @property
+    def height(self) -> np.ndarray:
+        return self.bottom - self.top
+
+    def as_array(self) -> np.ndarray:
+        return np.stack([self.left, self.top, self.right, self.bottom], axis=1)
+
+    def centers(self) -> np.ndarray:
+        return np.stack([(self.left + self.right) / 2, (self.top + self.bottom) / 2], axis=1)
+
+    def extent(self) -> Tuple[int, int, int, int]:
+        return (int(self.left.min()), int(self.top.min()), int(self.right.max()), int(self.bottom.max()))
+
+    def contained_in(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        return (self.left > left) & (self.right < right) & (self.top > top) & (self.bottom < bottom)
+
+    def intersects(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        return (self.left < right) & (self.right > left) & (self.top < bottom) & (self.bottom > top)
+
+    def in_window(self, x: int, y: int, size: int = 512) -> np.ndarray:
+        return self.contained_in(x, y, x + size, y + size)
+
+    def translate(self, dx: int, dy: int) -> 'BoxArray':
+        return BoxArray(self.left + dx, self.top + dy, self.right + dx, self.bottom + dy, self.labels)
+
+    def to_annotations(self, class_id: int = 1) -> List[dict]:
+        return [{
+            'class_id': class_id,
+            'top': top,
+            'left': left,
+            'width': width,
+            'height': height,
+        } for left, top, width, height in zip(self.left.tolist(), self.top.tolist(),
+                                              self.width.tolist(), self.height.tolist())]
+
+    @classmethod
+    def concatenate(cls, arrays: Sequence['BoxArray']) -> 'BoxArray':
+        if not arrays:
+            return cls.empty()
+
+        return cls(*(np.concatenate([getattr(a, name) for a in arrays])
+                     for name in ('left', 'top', 'right', 'bottom', 'labels')))
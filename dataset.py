@@ -1,59 +1,226 @@
+import hashlib
 import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import IncompleteRead
+from typing import Callable, Dict, Optional, Tuple
 import urllib.request
-from tqdm.notebook import tqdm
-
-def download_dataset():
-    downloadableFiles = {'WSI/deb768e5efb9d1dcbc13.svs' : #18
-                             'https://ndownloader.figshare.com/files/22407414',
-                         'WSI/d37ab62158945f22deed.svs' : #19
-                             'https://ndownloader.figshare.com/files/22585835',
-                         'WSI/022857018aa597374b6c.svs': #1,
-                             'https://ndownloader.figshare.com/files/22407537',
-                         'WSI/69a02453620ade0edefd.svs': #2
-                              'https://ndownloader.figshare.com/files/22407411', 
-                         'WSI/a8773be388e12df89edd.svs': #3
-                              'https://ndownloader.figshare.com/files/22407540',
-                         'WSI/c4b95da36e32993289cb.svs': #4
-                              'https://ndownloader.figshare.com/files/22407552',
-                         'WSI/3d3d04eca056556b0b26.svs': #5
-                              'https://ndownloader.figshare.com/files/22407585',
-                         'WSI/d0423ef9a648bb66a763.svs': #6
-                              'https://ndownloader.figshare.com/files/22407624',
-                         'WSI/50cf88e9a33df0c0c8f9.svs': #7
-                              'https://ndownloader.figshare.com/files/22407531',
-                         'WSI/084383c18b9060880e82.svs': #8
-                             'https://ndownloader.figshare.com/files/22407486',
-                         'WSI/4eee7b944ad5e46c60ce.svs': #9
-                             'https://ndownloader.figshare.com/files/22407528',
-                         'WSI/2191a7aa287ce1d5dbc0.svs' : #10
-                             'https://ndownloader.figshare.com/files/22407525',
-                         'WSI/13528f1921d4f1f15511.svs' : #11
-                             'https://ndownloader.figshare.com/files/22407519',
-                         'WSI/2d56d1902ca533a5b509.svs' : #12
-                             'https://ndownloader.figshare.com/files/22407522',
-                         'WSI/460906c0b1fe17ea5354.svs' : #13
-                             'https://ndownloader.figshare.com/files/22407447',
-                         'WSI/da18e7b9846e9d38034c.svs' : #14
-                             'https://ndownloader.figshare.com/files/22407453',
-                         'WSI/72c93e042d0171a61012.svs' : #15
-                             'https://ndownloader.figshare.com/files/22407456',
-                         'WSI/b1bdee8e5e3372174619.svs' : #16
-                             'https://ndownloader.figshare.com/files/22407423',
-                         'WSI/fa4959e484beec77543b.svs' : #17
-                             'https://ndownloader.figshare.com/files/22407459',
-                         'WSI/e09512d530d933e436d5.svs' : #20
-                             'https://ndownloader.figshare.com/files/22407465',
-                         'WSI/d7a8af121d7d4f3fbf01.svs' : #21
-                             'https://ndownloader.figshare.com/files/22407477',
-                        }
-    
-    os.makedirs('WSI', exist_ok=True)
-    tqdm.write('Downloading all files from figshare (37 GB download)')
-
-    for fname in tqdm(list(downloadableFiles.keys())):
-        try:
-            urllib.request.urlretrieve(downloadableFiles[fname], fname)
-        except HTTPError as e:
-            print(e)
-
-                    
+from urllib.error import HTTPError, URLError
+
+from tqdm.auto import tqdm
+
+# Maps the local path of every slide of the dataset to its download URL.
+DATASET_FILES = {'WSI/deb768e5efb9d1dcbc13.svs' : #18
+                     'https://ndownloader.figshare.com/files/22407414',
+                 'WSI/d37ab62158945f22deed.svs' : #19
+                     'https://ndownloader.figshare.com/files/22585835',
+                 'WSI/022857018aa597374b6c.svs': #1,
+                     'https://ndownloader.figshare.com/files/22407537',
+                 'WSI/69a02453620ade0edefd.svs': #2
+                      'https://ndownloader.figshare.com/files/22407411', 
+                 'WSI/a8773be388e12df89edd.svs': #3
+                      'https://ndownloader.figshare.com/files/22407540',
+                 'WSI/c4b95da36e32993289cb.svs': #4
+                      'https://ndownloader.figshare.com/files/22407552',
+                 'WSI/3d3d04eca056556b0b26.svs': #5
+                      'https://ndownloader.figshare.com/files/22407585',
+                 'WSI/d0423ef9a648bb66a763.svs': #6
+                      'https://ndownloader.figshare.com/files/22407624',
+                 'WSI/50cf88e9a33df0c0c8f9.svs': #7
+                      'https://ndownloader.figshare.com/files/22407531',
+                 'WSI/084383c18b9060880e82.svs': #8
+                     'https://ndownloader.figshare.com/files/22407486',
+                 'WSI/4eee7b944ad5e46c60ce.svs': #9
+                     'https://ndownloader.figshare.com/files/22407528',
+                 'WSI/2191a7aa287ce1d5dbc0.svs' : #10
+                     'https://ndownloader.figshare.com/files/22407525',
+                 'WSI/13528f1921d4f1f15511.svs' : #11
+                     'https://ndownloader.figshare.com/files/22407519',
+                 'WSI/2d56d1902ca533a5b509.svs' : #12
+                     'https://ndownloader.figshare.com/files/22407522',
+                 'WSI/460906c0b1fe17ea5354.svs' : #13
+                     'https://ndownloader.figshare.com/files/22407447',
+                 'WSI/da18e7b9846e9d38034c.svs' : #14
+                     'https://ndownloader.figshare.com/files/22407453',
+                 'WSI/72c93e042d0171a61012.svs' : #15
+                     'https://ndownloader.figshare.com/files/22407456',
+                 'WSI/b1bdee8e5e3372174619.svs' : #16
+                     'https://ndownloader.figshare.com/files/22407423',
+                 'WSI/fa4959e484beec77543b.svs' : #17
+                     'https://ndownloader.figshare.com/files/22407459',
+                 'WSI/e09512d530d933e436d5.svs' : #20
+                     'https://ndownloader.figshare.com/files/22407465',
+                 'WSI/d7a8af121d7d4f3fbf01.svs' : #21
+                     'https://ndownloader.figshare.com/files/22407477',
+                }
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+def _expected_size(headers, status: int) -> Optional[int]:
+    # Size of the whole file: from Content-Range on 206 and 416 responses
+    # ("bytes 100-199/1000", "bytes */1000"), from Content-Length on 200 ones.
+    content_range = headers.get('Content-Range') if headers is not None else None
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        return int(total) if total.isdigit() else None
+
+    content_length = headers.get('Content-Length') if headers is not None else None
+    if status == 200 and content_length and content_length.isdigit():
+        return int(content_length)
+
+    return None
+
+
+def _fetch(url: str,
+           part_path: str,
+           progress: Optional[Callable[[int], None]],
+           timeout: float) -> Tuple[int, Optional[int], int]:
+    # Appends the missing bytes to the partial file; returns the number of bytes
+    # received, the size of the whole file if the server says, and the status.
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header('Range', f'bytes={offset}-')
+
+    downloaded = 0
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            expected = _expected_size(response.headers, response.status)
+
+            # A server that ignores the Range header sends the whole file again.
+            mode = 'ab' if response.status == 206 else 'wb'
+            if mode == 'wb' and progress is not None and offset > 0:
+                progress(-offset)
+
+            with open(part_path, mode) as part:
+                for data in iter(lambda: response.read(_CHUNK_SIZE), b''):
+                    part.write(data)
+                    downloaded += len(data)
+                    if progress is not None:
+                        progress(len(data))
+
+            return downloaded, expected, response.status
+    except HTTPError as e:
+        # 416: the partial file is at least as long as the file, whose size
+        # comes in Content-Range.
+        if e.code != 416:
+            raise
+        return downloaded, _expected_size(e.headers, e.code), e.code
+    except (IncompleteRead, ConnectionError, socket.timeout, URLError):
+        # The connection closed or timed out before the end: what was written
+        # is kept, and the next attempt resumes from there.
+        return downloaded, None, 0
+
+
+def download_file(url: str,
+                  path: str,
+                  sha256: Optional[str] = None,
+                  progress: Optional[Callable[[int], None]] = None,
+                  timeout: float = 60,
+                  retries: int = 3,
+                  retry_delay: float = 1.0) -> int:
+
+    # Files only get their final name once complete (and verified), so an
+    # existing file does not need to be downloaded again.
+    if os.path.exists(path):
+        if sha256 is None or _sha256(path) == sha256:
+            return 0
+        os.remove(path)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    part_path = path + '.part'
+    downloaded = 0
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+
+        received, expected, status = _fetch(url, part_path, progress, timeout)
+        downloaded += received
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        # Complete when the size is the one announced by the server; a response
+        # without any size is trusted only if it was received to the end.
+        if size > 0 and (size == expected or (expected is None and status in (200, 206))):
+            break
+
+        if (expected is not None and size > expected) or (status == 416 and expected is None):
+            # The partial file cannot be part of this file: start over.
+            os.remove(part_path)
+            if progress is not None:
+                progress(-size)
+    else:
+        raise DownloadError(f'Incomplete download of {path}: {size} of {expected if expected is not None else "?"} '
+                            f'bytes after {retries + 1} attempts, kept the partial download')
+
+    if sha256 is not None and _sha256(part_path) != sha256:
+        os.remove(part_path)
+        raise DownloadError(f'SHA256 mismatch for {path}, removed the partial download')
+
+    os.replace(part_path, path)
+
+    return downloaded
+
+
+def download_dataset(files: Dict[str, str] = DATASET_FILES,
+                     base_path: str = '.',
+                     max_workers: int = 4,
+                     checksums: Optional[Dict[str, str]] = None) -> Dict[str, Exception]:
+
+    checksums = checksums or {}
+    paths = {fname: os.path.join(base_path, fname) for fname in files}
+
+    tqdm.write(f'Downloading {len(files)} files using {max_workers} parallel downloads')
+
+    # Partial downloads count towards the progress, since they are resumed.
+    already = sum(os.path.getsize(p + '.part') for p in paths.values() if os.path.exists(p + '.part'))
+    progress = tqdm(unit='B', unit_scale=True, unit_divisor=1024, initial=already, desc='Downloading...')
+    lock = threading.Lock()
+
+    def report(n: int) -> None:
+        with lock:
+            progress.update(n)
+
+    errors = {}
+    total = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_file, files[fname], paths[fname], checksums.get(fname), report): fname
+            for fname in files
+        }
+        for future in as_completed(futures):
+            fname = futures[future]
+            try:
+                total += future.result()
+            except (HTTPError, URLError, OSError, DownloadError) as e:
+                errors[fname] = e
+                tqdm.write(f'{fname}: {e}')
+
+    progress.close()
+
+    elapsed = time.monotonic() - start
+    tqdm.write(f'Downloaded {total / 1024 ** 3:.2f} GiB in {elapsed:.0f} s '
+               f'({total / 1024 ** 2 / max(elapsed, 1e-9):.1f} MiB/s), {len(errors)} failed')
+
+    return errors
@@ -0,0 +1,247 @@
+from collections import OrderedDict
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import re
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from openslide.deepzoom import DeepZoomGenerator
+from PIL import ImageDraw
+
+import instrumentation
+from inference import Detection
+from slidepool import handle_pool
+from spatial import GridIndex
+
+# Outline colors, assigned to labels in sorted order.
+PALETTE = [(0, 0, 255), (255, 0, 0), (0, 160, 0), (255, 140, 0), (160, 0, 200), (0, 170, 200)]
+
+
+class DeepZoomSlide:
+    """Deep Zoom pyramid of one slide, with detection boxes drawn into each tile.
+
+    Tiles are rendered on first request and cached on disk, keyed by the slide,
+    the detections and the tile parameters. Each tile only looks up the boxes
+    that intersect it, so the cost of a tile does not grow with the number of
+    detections on the slide.
+    """
+
+    def __init__(self,
+                 file: str,
+                 detections: Sequence[Detection] = (),
+                 tile_size: int = 254,
+                 overlap: int = 1,
+                 image_format: str = 'jpeg',
+                 quality: int = 75,
+                 cache_dir: Optional[str] = None,
+                 line_width: int = 2):
+
+        self.file = str(file)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.image_format = image_format
+        self.quality = quality
+        self.line_width = line_width
+
+        self.boxes = np.array([[d.left, d.top, d.right, d.bottom] for d in detections], dtype=np.float64).reshape(-1, 4)
+        self.labels = [d.label for d in detections]
+        # Boxes are tiny next to the area of a low-zoom tile, so cells are large
+        # enough to keep the index small while still pruning most boxes.
+        self.index = GridIndex(np.floor(self.boxes), cell_size=2048)
+        self.colors = {label: PALETTE[i % len(PALETTE)] for i, label in enumerate(sorted(set(self.labels)))}
+
+        self.key = self._key()
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, self.key)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._handle = None
+        self._generator = None
+        self._lock = threading.Lock()
+
+    def _key(self) -> str:
+        stat = os.stat(self.file)
+        h = hashlib.sha256()
+        h.update(f'{os.path.abspath(self.file)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+        h.update(f'{self.tile_size}:{self.overlap}:{self.image_format}:{self.quality}:{self.line_width}'.encode('utf-8'))
+        h.update(self.boxes.tobytes())
+        h.update('\n'.join(self.labels).encode('utf-8'))
+        return h.hexdigest()[:32]
+
+    @property
+    def generator(self) -> DeepZoomGenerator:
+        # The handle comes from the shared pool; if it was evicted and reopened,
+        # the generator is rebuilt on the new handle.
+        handle = handle_pool.get(self.file)
+        with self._lock:
+            if handle is not self._handle:
+                self._generator = DeepZoomGenerator(handle, tile_size=self.tile_size, overlap=self.overlap)
+                self._handle = handle
+            return self._generator
+
+    @property
+    def extension(self) -> str:
+        return 'jpeg' if self.image_format.lower() in ('jpg', 'jpeg') else self.image_format.lower()
+
+    def dzi(self) -> str:
+        return self.generator.get_dzi(self.extension)
+
+    def boxes_in_tile(self, level: int, col: int, row: int) -> Tuple[np.ndarray, List[str]]:
+        # Boxes intersecting the tile, in tile pixel coordinates.
+        generator = self.generator
+        (x, y), slide_level, (width, height) = generator.get_tile_coordinates(level, (col, row))
+        tile_width, tile_height = generator.get_tile_dimensions(level, (col, row))
+        downsample = handle_pool.get(self.file).level_downsamples[slide_level]
+
+        extent_x, extent_y = width * downsample, height * downsample
+        ids = self.index.intersecting(x, y, int(np.ceil(x + extent_x)), int(np.ceil(y + extent_y)))
+
+        scale = np.array([tile_width / extent_x, tile_height / extent_y] * 2)
+        boxes = (self.boxes[ids] - np.array([x, y, x, y])) * scale
+        return boxes, [self.labels[i] for i in ids]
+
+    def render_tile(self, level: int, col: int, row: int) -> bytes:
+        with instrumentation.timer('dzi.render'):
+            tile = self.generator.get_tile(level, (col, row))
+            boxes, labels = self.boxes_in_tile(level, col, row)
+
+            if len(boxes):
+                draw = ImageDraw.Draw(tile)
+                for (left, top, right, bottom), label in zip(boxes, labels):
+                    # Keep at least a dot visible for boxes smaller than a pixel.
+                    draw.rectangle([left, top, max(right, left + 1), max(bottom, top + 1)],
+                                   outline=self.colors[label], width=self.line_width)
+
+            buffer = io.BytesIO()
+            tile.save(buffer, format='JPEG' if self.extension == 'jpeg' else self.extension.upper(),
+                      quality=self.quality)
+            return buffer.getvalue()
+
+    def tile(self, level: int, col: int, row: int) -> bytes:
+        if self.cache_dir is None:
+            return self.render_tile(level, col, row)
+
+        path = os.path.join(self.cache_dir, str(level), f'{col}_{row}.{self.extension}')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            instrumentation.count('dzi.cache_hits')
+            return data
+        except FileNotFoundError:
+            pass
+
+        instrumentation.count('dzi.cache_misses')
+        data = self.render_tile(level, col, row)
+
+        # Written under a temporary name, so a concurrent request never reads a
+        # partial tile.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return data
+
+
+_TILE_PATH = re.compile(r'^/slides/(?P<slide>[\w.-]+)_files/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)\.\w+$')
+_DZI_PATH = re.compile(r'^/slides/(?P<slide>[\w.-]+)\.dzi$')
+
+
+class TileServer(ThreadingHTTPServer):
+    """Serves the registered slides as `/slides/<id>.dzi` and `/slides/<id>_files/<level>/<col>_<row>.<ext>`."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], cache_dir: Optional[str] = None, max_slides: int = 32):
+        super().__init__(address, _TileHandler)
+        self.cache_dir = cache_dir
+        self.max_slides = max_slides
+        self.slides: 'OrderedDict[str, DeepZoomSlide]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_slide(self, file: str, detections: Sequence[Detection] = (), **options) -> str:
+        slide = DeepZoomSlide(file, detections, cache_dir=self.cache_dir, **options)
+        slide_id = slide.key
+        with self._lock:
+            # The id depends on the detections, so registering the same slide with
+            # other detections never serves tiles from the previous ones. Every
+            # upload registers a slide, so only the most recently used are kept;
+            # their rendered tiles stay in the disk cache.
+            self.slides.setdefault(slide_id, slide)
+            self.slides.move_to_end(slide_id)
+            while len(self.slides) > self.max_slides:
+                self.slides.popitem(last=False)
+        return slide_id
+
+    def get_slide(self, slide_id: str) -> Optional[DeepZoomSlide]:
+        with self._lock:
+            slide = self.slides.get(slide_id)
+            if slide is not None:
+                self.slides.move_to_end(slide_id)
+            return slide
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status: int, body: bytes, content_type: str, cache: bool = False) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # The viewer is embedded in a page served from another port.
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if cache:
+            self.send_header('Cache-Control', 'public, max-age=86400, immutable')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, b'ok', 'text/plain')
+            return
+
+        match = _TILE_PATH.match(self.path) or _DZI_PATH.match(self.path)
+        slide = self.server.get_slide(match['slide']) if match else None
+        if slide is None:
+            self.send_error(404)
+            return
+
+        if match.re is _DZI_PATH:
+            self._send(200, slide.dzi().encode('utf-8'), 'application/xml')
+            return
+
+        try:
+            data = slide.tile(int(match['level']), int(match['col']), int(match['row']))
+        except ValueError:
+            # Level or address outside the pyramid.
+            self.send_error(404)
+            return
+
+        self._send(200, data, f'image/{slide.extension}', cache=True)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_tiles(port: int, address: str = '', cache_dir: Optional[str] = None, max_slides: int = 32) -> TileServer:
+    server = TileServer((address, port), cache_dir=cache_dir, max_slides=max_slides)
+    threading.Thread(target=server.serve_forever, name='deepzoom-tiles', daemon=True).start()
+    return server
+
+
+_shared_server: Optional[TileServer] = None
+_shared_lock = threading.Lock()
+
+
+def shared_tile_server(port: int, address: str = '', cache_dir: Optional[str] = None, max_slides: int = 32) -> TileServer:
+    # One server per process: started by whichever caller comes first, e.g. a
+    # launcher at process start, and returned as is to the later ones.
+    global _shared_server
+    with _shared_lock:
+        if _shared_server is None:
+            _shared_server = serve_tiles(port, address, cache_dir, max_slides)
+        return _shared_server
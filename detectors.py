@@ -0,0 +1,231 @@
+"""Detectors that return Rekognition Custom Labels output, from Rekognition or a local model.
+
+Every detector has `detect(image_bytes, min_confidence)`, which returns a
+`{'CustomLabels': [...]}` response (with `min_confidence=None`, the model's own
+thresholds apply), and `detect_custom_labels(**kwargs)` with
+the same arguments as the Rekognition client, so that any detector can be used
+wherever a client is, e.g. in `inference.detect_slide`.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+import io
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+import instrumentation
+from rekognition_client import RekognitionClient
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class Detector(ABC):
+
+    # Identifies the model, e.g. in cache keys.
+    model_id: str = ''
+
+    @abstractmethod
+    def detect(self, image_bytes: bytes, min_confidence: Optional[float] = None) -> Dict[str, Any]:
+        pass
+
+    def detect_custom_labels(self, Image: Dict[str, bytes], MinConfidence: Optional[float] = None,
+                             **kwargs) -> Dict[str, Any]:
+        return self.detect(Image['Bytes'], MinConfidence)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class RekognitionDetector(Detector):
+
+    def __init__(self, project_version_arn: str, client: Optional[RekognitionClient] = None):
+        self.model_id = project_version_arn
+        self.client = client if client is not None else RekognitionClient()
+
+    def detect(self, image_bytes: bytes, min_confidence: Optional[float] = None) -> Dict[str, Any]:
+        # Rekognition applies each label's assumed threshold when MinConfidence is
+        # not sent.
+        kwargs = {} if min_confidence is None else {'MinConfidence': min_confidence}
+        return self.client.detect_custom_labels(
+            ProjectVersionArn=self.model_id,
+            Image={
+                'Bytes': image_bytes
+            },
+            **kwargs,
+        )
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return self.client.stats
+
+
+def boxes_to_custom_labels(boxes: np.ndarray,
+                           scores: np.ndarray,
+                           label_ids: np.ndarray,
+                           labels: Sequence[str],
+                           width: int,
+                           height: int,
+                           min_confidence: Optional[float] = None) -> List[Dict[str, Any]]:
+    # Boxes are (x1, y1, x2, y2) in pixels of a width x height image, scores in
+    # [0, 1]; Rekognition reports relative geometry and confidences in percent.
+    # A local model has no per-label thresholds, so None keeps every scored box.
+    confidences = scores * 100
+    keep = confidences >= (0.0 if min_confidence is None else min_confidence)
+    custom_labels = []
+    for (x1, y1, x2, y2), confidence, label_id in zip(boxes[keep].tolist(), confidences[keep].tolist(),
+                                                       label_ids[keep].tolist()):
+        left, right = min(max(x1 / width, 0.0), 1.0), min(max(x2 / width, 0.0), 1.0)
+        top, bottom = min(max(y1 / height, 0.0), 1.0), min(max(y2 / height, 0.0), 1.0)
+        custom_labels.append({
+            'Name': labels[int(label_id)],
+            'Confidence': confidence,
+            'Geometry': {'BoundingBox': {
+                'Width': right - left,
+                'Height': bottom - top,
+                'Left': left,
+                'Top': top,
+            }},
+        })
+
+    # Rekognition returns the most confident labels first.
+    custom_labels.sort(key=lambda label: -label['Confidence'])
+    return custom_labels
+
+
+class OnnxDetector(Detector):
+    """Object detection model run locally with ONNX Runtime on the CPU.
+
+    The model takes a float32 N x 3 x H x W batch of RGB images scaled to [0, 1],
+    and returns, in this order, boxes (N x K x 4, x1 y1 x2 y2 in input pixels),
+    scores (N x K, in [0, 1]) and label indices into `labels` (N x K), with
+    unused slots scored 0. Models with other outputs can pass `postprocess`,
+    which maps the session outputs to that form.
+
+    One session is shared by every caller. Calls that arrive from several
+    threads within `max_wait` seconds of each other, as the tiles sent by
+    `iter_tile_detections` do, run as one batch of up to `batch_size` images.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 labels: Sequence[str],
+                 input_size: Optional[Tuple[int, int]] = None,
+                 batch_size: int = 8,
+                 max_wait: float = 0.005,
+                 threads: Optional[int] = None,
+                 postprocess: Optional[Callable[[List[np.ndarray]], Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None):
+
+        if onnxruntime is None:
+            raise ImportError('OnnxDetector needs the onnxruntime package')
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        # (width, height) images are resized to; fixed by the model when its
+        # input shape says so.
+        height, width = self.session.get_inputs()[0].shape[2:]
+        if input_size is None:
+            input_size = (width, height) if isinstance(width, int) and isinstance(height, int) else (512, 512)
+        self.input_size = input_size
+
+        self.labels = list(labels)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.postprocess = postprocess
+        stat = os.stat(model_path)
+        self.model_id = f'onnx:{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+        self.batches = 0
+        self.images = 0
+        self._requests = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _prepare(self, image_bytes: bytes) -> np.ndarray:
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        if image.size != tuple(self.input_size):
+            # Geometry is reported relative to the image, so resizing does not
+            # change it.
+            image = image.resize(self.input_size, Image.BILINEAR)
+        return np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255
+
+    def _run(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with instrumentation.timer('onnx.run'):
+            outputs = self.session.run(None, {self.input_name: batch})
+        with self._lock:
+            self.batches += 1
+            self.images += len(batch)
+        if self.postprocess is not None:
+            return self.postprocess(outputs)
+        boxes, scores, label_ids = outputs[:3]
+        return boxes, scores, label_ids
+
+    def _serve(self) -> None:
+        while True:
+            requests = [self._requests.get()]
+            # Wait briefly for other callers, so their images share the batch.
+            try:
+                while len(requests) < self.batch_size:
+                    requests.append(self._requests.get(timeout=self.max_wait))
+            except queue.Empty:
+                pass
+
+            try:
+                boxes, scores, label_ids = self._run(np.stack([array for array, _ in requests]))
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            for i, (_, future) in enumerate(requests):
+                future.set_result((boxes[i], scores[i], label_ids[i]))
+
+    def detect(self, image_bytes: bytes, min_confidence: Optional[float] = None) -> Dict[str, Any]:
+        # Decoding happens on the caller's thread, inference on the batching one.
+        array = self._prepare(image_bytes)
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._serve, name='onnx-detector', daemon=True)
+                self._worker.start()
+
+        future = Future()
+        self._requests.put((array, future))
+        boxes, scores, label_ids = future.result()
+
+        width, height = self.input_size
+        return {'CustomLabels': boxes_to_custom_labels(boxes, scores, label_ids, self.labels,
+                                                       width, height, min_confidence)}
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'batches': self.batches,
+            'images': self.images,
+            'mean_batch_size': self.images / self.batches if self.batches else 0.0,
+        }
+
+
+def detector_from_environment(project_version_arn: str) -> Detector:
+    # DETECTOR_BACKEND selects the backend: 'rekognition' (default) or 'onnx'.
+    backend = os.environ.get('DETECTOR_BACKEND', 'rekognition').lower()
+    if backend == 'onnx':
+        return OnnxDetector(os.environ['ONNX_MODEL_PATH'],
+                            labels=os.environ.get('ONNX_LABELS', 'mitotic figure').split(','),
+                            batch_size=int(os.environ.get('ONNX_BATCH_SIZE', 8)),
+                            threads=int(os.environ['ONNX_THREADS']) if 'ONNX_THREADS' in os.environ else None)
+    if backend == 'rekognition':
+        rate = float(os.environ['REKOGNITION_MAX_TPS']) if 'REKOGNITION_MAX_TPS' in os.environ else None
+        return RekognitionDetector(project_version_arn, RekognitionClient(rate=rate))
+
+    raise ValueError(f"DETECTOR_BACKEND must be 'rekognition' or 'onnx', got {backend!r}")
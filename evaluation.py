@@ -0,0 +1,211 @@
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from boxes import BoxArray
+
+try:
+    from scipy.spatial import cKDTree
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import maximum_bipartite_matching
+except ImportError:
+    cKDTree = None
+
+# A detection counts as a mitotic figure if its center is within this many
+# level-0 pixels of an annotation's, as in the MITOS_WSI_CMC evaluation.
+MATCH_RADIUS = 25
+
+
+class Scores(NamedTuple):
+    # One entry per threshold: detections with a confidence of at least
+    # `thresholds[i]` are kept.
+    thresholds: np.ndarray
+    tp: np.ndarray
+    fp: np.ndarray
+    fn: np.ndarray
+
+    @property
+    def precision(self) -> np.ndarray:
+        return self.tp / np.maximum(self.tp + self.fp, 1)
+
+    @property
+    def recall(self) -> np.ndarray:
+        return self.tp / np.maximum(self.tp + self.fn, 1)
+
+    @property
+    def f1(self) -> np.ndarray:
+        return 2 * self.tp / np.maximum(2 * self.tp + self.fp + self.fn, 1)
+
+    def best(self) -> Tuple[float, float]:
+        # Threshold with the highest F1, and that F1.
+        i = int(np.argmax(self.f1))
+        return float(self.thresholds[i]), float(self.f1[i])
+
+
+class Evaluation(NamedTuple):
+    overall: Scores
+    slides: List[Scores]
+
+
+def _points_and_scores(detections) -> Tuple[np.ndarray, np.ndarray]:
+    # `Detection`s, or an N x 3 array of (x, y, confidence).
+    if len(detections) > 0 and hasattr(detections[0], 'left'):
+        rows = np.array([[(d.left + d.right) / 2, (d.top + d.bottom) / 2, d.confidence] for d in detections],
+                        dtype=np.float64)
+    else:
+        rows = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+    return rows[:, :2], rows[:, 2]
+
+
+def _ground_truth_points(ground_truth) -> np.ndarray:
+    if isinstance(ground_truth, BoxArray):
+        return ground_truth.centers()
+    return np.asarray(ground_truth, dtype=np.float64).reshape(-1, 2)
+
+
+def _grid_pairs(detections: np.ndarray, ground_truth: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    # Without scipy: hash the ground truth into cells of `radius`, so that every
+    # match of a detection is in its own cell or one of the eight around it.
+    origin = np.minimum(detections.min(axis=0), ground_truth.min(axis=0)) - radius
+    gt_cells = np.floor((ground_truth - origin) / radius).astype(np.int64)
+    det_cells = np.floor((detections - origin) / radius).astype(np.int64)
+    cols = int(max(gt_cells[:, 0].max(), det_cells[:, 0].max())) + 2
+
+    gt_keys = gt_cells[:, 1] * cols + gt_cells[:, 0]
+    order = np.argsort(gt_keys, kind='stable')
+    gt_keys = gt_keys[order]
+
+    det_ids, gt_ids = [], []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            keys = (det_cells[:, 1] + dy) * cols + det_cells[:, 0] + dx
+            starts = np.searchsorted(gt_keys, keys, side='left')
+            counts = np.searchsorted(gt_keys, keys, side='right') - starts
+
+            # One entry per (detection, ground truth in that cell) pair.
+            ids = np.repeat(np.arange(len(detections)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            det_ids.append(ids)
+            gt_ids.append(order[starts[ids] + offsets])
+
+    return np.concatenate(det_ids), np.concatenate(gt_ids)
+
+
+def candidate_pairs(detections: np.ndarray,
+                    ground_truth: np.ndarray,
+                    radius: float = MATCH_RADIUS) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Every (detection, ground truth) pair closer than `radius`, with its distance.
+    if len(detections) == 0 or len(ground_truth) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    if cKDTree is not None:
+        pairs = cKDTree(detections).sparse_distance_matrix(cKDTree(ground_truth), radius, output_type='ndarray')
+        return pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+
+    det_ids, gt_ids = _grid_pairs(detections, ground_truth, radius)
+    distances = np.hypot(*(detections[det_ids] - ground_truth[gt_ids]).T)
+    keep = distances <= radius
+    return det_ids[keep], gt_ids[keep], distances[keep]
+
+
+def greedy_matches(scores: np.ndarray,
+                   det_ids: np.ndarray,
+                   gt_ids: np.ndarray,
+                   distances: np.ndarray) -> np.ndarray:
+    # Detections by decreasing confidence each take the closest free ground
+    # truth. Keeping only the detections above a threshold keeps their matches,
+    # so a single matching is valid for every threshold.
+    order = np.lexsort((distances, -scores[det_ids]))
+    matched = [False] * len(scores)
+    gt_taken = set()
+    for d, g in zip(det_ids[order].tolist(), gt_ids[order].tolist()):
+        if not matched[d] and g not in gt_taken:
+            matched[d] = True
+            gt_taken.add(g)
+
+    return np.array(matched, dtype=bool)
+
+
+def _threshold_bins(scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    # Number of thresholds each score passes.
+    return np.searchsorted(thresholds, scores, side='right')
+
+
+def _counts_above(bins: np.ndarray, groups: np.ndarray, group_count: int, threshold_count: int) -> np.ndarray:
+    # counts[g, i] is the number of items of group g passing threshold i: a
+    # histogram over (group, bins), summed from the highest bin down.
+    histogram = np.bincount(groups * (threshold_count + 1) + bins,
+                            minlength=group_count * (threshold_count + 1)).reshape(group_count, threshold_count + 1)
+    return np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+
+def evaluate(detections: Sequence,
+             ground_truth: Sequence,
+             radius: float = MATCH_RADIUS,
+             thresholds: Optional[Sequence[float]] = None,
+             assignment: str = 'greedy') -> Evaluation:
+    """Precision, recall and F1 per slide and overall, for every confidence threshold.
+
+    `detections[i]` and `ground_truth[i]` belong to slide i, in the same
+    coordinates: `Detection`s from `detect_slide`, or rows of (x, y, confidence),
+    against the boxes from `get_slides` or rows of (x, y). A detection is a true
+    positive if it is matched one-to-one with an annotation within `radius`.
+
+    With `assignment='greedy'` the matching is done once for all thresholds.
+    `'hungarian'` (needs scipy) finds the largest possible number of matches at
+    every threshold, which is what an optimal assignment yields for counting.
+    """
+    if thresholds is None:
+        thresholds = np.arange(0, 101, dtype=np.float64)
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    if assignment not in ('greedy', 'hungarian'):
+        raise ValueError(f"assignment must be 'greedy' or 'hungarian', got {assignment!r}")
+    if assignment == 'hungarian' and cKDTree is None:
+        raise ImportError("assignment='hungarian' needs scipy")
+
+    # All slides are scored in one pass, by shifting each slide to its own
+    # range of x so that no pair can cross slides.
+    det_points, det_scores, det_slides, gt_points, gt_slides = [], [], [], [], []
+    for slide, (slide_detections, slide_ground_truth) in enumerate(zip(detections, ground_truth)):
+        points, scores = _points_and_scores(slide_detections)
+        det_points.append(points)
+        det_scores.append(scores)
+        det_slides.append(np.full(len(points), slide))
+        gt = _ground_truth_points(slide_ground_truth)
+        gt_points.append(gt)
+        gt_slides.append(np.full(len(gt), slide))
+
+    slide_count = len(det_points)
+    det_points, det_scores, det_slides = np.concatenate(det_points), np.concatenate(det_scores), np.concatenate(det_slides)
+    gt_points, gt_slides = np.concatenate(gt_points), np.concatenate(gt_slides)
+
+    all_points = np.concatenate([det_points, gt_points])
+    span = (np.ptp(all_points[:, 0]) if len(all_points) else 0) + 4 * radius
+    det_points = det_points + np.stack([det_slides * span, np.zeros(len(det_slides))], axis=1)
+    gt_points = gt_points + np.stack([gt_slides * span, np.zeros(len(gt_slides))], axis=1)
+
+    det_ids, gt_ids, distances = candidate_pairs(det_points, gt_points, radius)
+    bins = _threshold_bins(det_scores, thresholds)
+    positives = _counts_above(bins, det_slides, slide_count, len(thresholds))
+    gt_counts = np.bincount(gt_slides, minlength=slide_count)[:, None]
+
+    if assignment == 'greedy':
+        matched = greedy_matches(det_scores, det_ids, gt_ids, distances)
+        tp = _counts_above(bins[matched], det_slides[matched], slide_count, len(thresholds))
+    else:
+        tp = np.zeros((slide_count, len(thresholds)), dtype=np.int64)
+        for i, threshold in enumerate(thresholds):
+            keep = det_scores[det_ids] >= threshold
+            graph = csr_matrix((np.ones(keep.sum()), (det_ids[keep], gt_ids[keep])),
+                               shape=(len(det_points), len(gt_points)))
+            match = maximum_bipartite_matching(graph, perm_type='column')
+            matched = match >= 0
+            tp[:, i] = np.bincount(det_slides[matched], minlength=slide_count)
+
+    fp = positives - tp
+    fn = gt_counts - tp
+
+    slides = [Scores(thresholds, tp[s], fp[s], fn[s]) for s in range(slide_count)]
+    overall = Scores(thresholds, tp.sum(axis=0), fp.sum(axis=0), fn.sum(axis=0))
+
+    return Evaluation(overall, slides)
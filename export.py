@@ -0,0 +1,177 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from boxes import BoxArray
+import instrumentation
+from manifest import ManifestWriter
+from patchstore import PatchStore
+from slidepool import handle_pool
+from spatial import GridIndex
+
+
+class ExportJob(NamedTuple):
+    slide_idx: int
+    x: int
+    y: int
+    channel: str
+
+
+class SlideSpec(NamedTuple):
+    file: str
+    level: int
+    down_factor: float
+    boxes: BoxArray
+    index: GridIndex
+
+
+def slide_specs(files: Sequence, lbl_bbox: Sequence) -> List[SlideSpec]:
+    # Workers only receive what they need to open the slide themselves, rather
+    # than the containers with their annotation dictionaries. The slide's grid
+    # index goes along, so that each patch only looks at the boxes near it.
+    return [SlideSpec(file=str(f.file),
+                      level=f.level,
+                      down_factor=f.down_factor,
+                      boxes=bboxes,
+                      index=f.index if f.index is not None else GridIndex(bboxes.as_array(), cell_size=f.width))
+            for f, (bboxes, labels) in zip(files, lbl_bbox)]
+
+
+# Per-process state, populated by `_init_worker`.
+_specs: List[SlideSpec] = []
+_options: dict = {}
+
+
+def _init_worker(specs: List[SlideSpec], options: dict) -> None:
+    global _specs, _options
+    _specs = specs
+    _options = options
+
+    # Handles inherited from the parent process through fork must not be shared.
+    handle_pool.clear()
+
+    # Measurements go back to the parent with each result, whatever the start
+    # method, rather than staying in the worker.
+    instrumentation.reset()
+    if options.get('instrumentation') is not None:
+        instrumentation.enable(**options['instrumentation'])
+    else:
+        instrumentation.disable()
+
+    if 'store' in options:
+        _options['patches'] = PatchStore(options['store'], mode='r+').patches
+
+
+def _read_job(job: ExportJob):
+    spec = _specs[job.slide_idx]
+    size = _options['size']
+
+    with instrumentation.timer('export.read_region'):
+        region = handle_pool.get(spec.file).read_region(
+            location=(int(job.x * spec.down_factor), int(job.y * spec.down_factor)),
+            level=spec.level,
+            size=(size, size))
+
+    # Boxes fully inside the patch, in patch coordinates.
+    inside = spec.boxes[spec.index.contained_in_window(job.x, job.y, size)]
+
+    return region, inside.translate(-job.x, -job.y)
+
+
+def _export_job(numbered_job) -> Tuple[str, str, List[dict], Optional[dict]]:
+    job_idx, job = numbered_job
+    region, boxes = _read_job(job)
+
+    filename = job_filename(job_idx)
+    with instrumentation.timer('export.png_encode'):
+        region.convert('RGB').save(os.path.join(_options['output_dir'], job.channel, filename))
+
+    return job.channel, filename, boxes.to_annotations(class_id=1), instrumentation.collect()
+
+
+def _store_job(numbered_job) -> Tuple[int, BoxArray, Optional[dict]]:
+    job_idx, job = numbered_job
+    region, boxes = _read_job(job)
+
+    # Straight from the decoded RGBA region into the memory map, as uint8.
+    with instrumentation.timer('export.store'):
+        _options['patches'][job_idx] = np.asarray(region)[:, :, :3]
+
+    return job_idx, boxes, instrumentation.collect()
+
+
+def job_filename(job_idx: int) -> str:
+    return f'slide_{job_idx}.png'
+
+
+def export_patches(jobs: Sequence[ExportJob],
+                   specs: List[SlideSpec],
+                   manifests: Dict[str, ManifestWriter],
+                   output_dir: str = 'rek_slides',
+                   size: int = 512,
+                   max_workers: Optional[int] = None,
+                   chunksize: int = 8) -> int:
+
+    for channel in set(job.channel for job in jobs):
+        os.makedirs(os.path.join(output_dir, channel), exist_ok=True)
+
+    options = {
+        'output_dir': output_dir,
+        'size': size,
+        'instrumentation': instrumentation.settings(),
+    }
+
+    # Jobs whose image is already in the manifest were exported by an earlier,
+    # interrupted run.
+    pending = [(job_idx, job) for job_idx, job in enumerate(jobs)
+               if job_filename(job_idx) not in manifests[job.channel]]
+
+    # `map` keeps the results in job order, so file names and manifest lines are
+    # the same regardless of how many workers run or which finishes first. Lines
+    # are written as results arrive, so memory does not grow with the export.
+    written = 0
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(specs, options)) as executor:
+        for channel, filename, annotations, metrics in tqdm(executor.map(_export_job, pending, chunksize=chunksize),
+                                                            total=len(pending),
+                                                            desc='Writing images...'):
+            instrumentation.merge(metrics)
+            written += manifests[channel].write(filename, annotations)
+
+    return written
+
+
+def build_patch_store(root: str,
+                      jobs: Sequence[ExportJob],
+                      specs: List[SlideSpec],
+                      size: int = 512,
+                      max_workers: Optional[int] = None,
+                      chunksize: int = 8) -> PatchStore:
+
+    store = PatchStore.create(root,
+                              slide_ids=[job.slide_idx for job in jobs],
+                              xs=[job.x for job in jobs],
+                              ys=[job.y for job in jobs],
+                              channels=[job.channel for job in jobs],
+                              size=size)
+
+    options = {
+        'store': root,
+        'size': size,
+        'instrumentation': instrumentation.settings(),
+    }
+
+    boxes = [BoxArray.empty()] * len(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(specs, options)) as executor:
+        for job_idx, job_boxes, metrics in tqdm(executor.map(_store_job, enumerate(jobs), chunksize=chunksize),
+                                                total=len(jobs),
+                                                desc='Extracting patches...'):
+            instrumentation.merge(metrics)
+            boxes[job_idx] = job_boxes
+
+    store.patches.flush()
+    store.set_boxes(boxes)
+
+    return store
@@ -8,6 +8,7 @@ from aws_cdk import (
     aws_ecr as ecr,
     aws_ecs as ecs,
     aws_ecs_patterns as ecs_patterns,
+    aws_elasticloadbalancingv2 as elbv2,
     aws_iam as iam,
     aws_ssm as ssm,
 )
@@ -59,6 +60,28 @@ class RekWsiStack(Stack):
             public_load_balancer=True,
         )
 
+        # Deep Zoom tiles for the slide viewer are served by the same container,
+        # on their own port and load balancer listener.
+        tile_port = 8502
+        fargate_service.task_definition.default_container.add_port_mappings(
+            ecs.PortMapping(container_port=tile_port)
+        )
+        tile_listener = fargate_service.load_balancer.add_listener(
+            'TileListener',
+            port=tile_port,
+            protocol=elbv2.ApplicationProtocol.HTTP,
+        )
+        tile_listener.add_targets(
+            'TileTargets',
+            port=tile_port,
+            protocol=elbv2.ApplicationProtocol.HTTP,
+            targets=[fargate_service.service.load_balancer_target(
+                container_name=fargate_service.task_definition.default_container.container_name,
+                container_port=tile_port,
+            )],
+            health_check=elbv2.HealthCheck(path='/health'),
+        )
+
         # CI/CD pipeline
         pipeline = codepipeline.Pipeline(self, 'RekWSIPipeline')
 
@@ -132,8 +155,8 @@ class RekWsiStack(Stack):
                     },
                     'build': {
                         'commands': [
-                            # Build the Docker image
-                            'cd fargate_app/streamlit_app && docker build -t $IMAGE_REPO_NAME:$IMAGE_TAG .',
+                            # Build the Docker image, using the repository root as build context
+                            'docker build -t $IMAGE_REPO_NAME:$IMAGE_TAG -f fargate_app/streamlit_app/Dockerfile .',
                             # Tag the image
                             'docker tag $IMAGE_REPO_NAME:$IMAGE_TAG '
                             '$AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com/$IMAGE_REPO_NAME:$IMAGE_TAG',
@@ -145,7 +168,6 @@ class RekWsiStack(Stack):
                             'docker push '
                             '$AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com/$IMAGE_REPO_NAME:$IMAGE_TAG',
                             # Generate imagedefinitions.json
-                            'cd ../..',
                             "printf '[{\"name\":\"%s\",\"imageUri\":\"%s\"}]' "
                             f"{container_name} "
                             "$AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com/$IMAGE_REPO_NAME:$IMAGE_TAG "
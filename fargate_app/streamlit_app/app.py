@@ -1,27 +1,121 @@
 import os
 
-import boto3
 import io
+import json
 import streamlit as st
+import streamlit.components.v1 as components
 from PIL import Image, ImageDraw
 
-rek_client = boto3.client('rekognition')
+from detection_cache import cache_from_environment
+from inference import load_detections
+import instrumentation
+from detectors import detector_from_environment
+from serve import DZI_PORT, tile_server
 
 # !!!
 # Replace the value for your project version ARN.
 # !!!
 PROJECT_VERSION_ARN = 'arn:aws:rekognition:<AWS_REGION>:<AWS_ACCOUNT_ID>:project/rek-pathology/version/rek-pathology.2021-99-99T11.22.33/1234567890123'
 
+# Whole slides are read from this directory, and their Deep Zoom tiles served on
+# their own port, next to the Streamlit one.
+SLIDE_DIR = os.environ.get('SLIDE_DIR', 'slides')
+SLIDE_EXTENSIONS = ('.svs', '.tif', '.tiff', '.ndpi', '.mrxs', '.scn', '.vms', '.vmu', '.bif')
+OPENSEADRAGON_URL = 'https://cdn.jsdelivr.net/npm/openseadragon@4.1/build/openseadragon/'
 
-uploaded_file = st.file_uploader('Image file')
+
+# Timers, and the Prometheus endpoint if configured, are set up once per server
+# process, from the INSTRUMENTATION_* environment variables.
+@st.cache_resource
+def get_instrumentation():
+    return instrumentation.configure_from_environment()
+
+
+get_instrumentation()
+
+
+# One detector per server process, shared by every session of the app: the
+# Rekognition client rate limits and retries throttled calls, and a local model
+# batches the images of concurrent sessions. DETECTOR_BACKEND selects it.
+@st.cache_resource
+def get_detector():
+    return detector_from_environment(PROJECT_VERSION_ARN)
+
+
+detector = get_detector()
+
+
+# Streamlit reruns this script on every interaction, so results are cached by
+# image contents, model and minimum confidence, in a cache that outlives reruns.
+@st.cache_resource
+def get_detection_cache():
+    return cache_from_environment()
+
+
+detection_cache = get_detection_cache()
+
+
+# Tiles are rendered on demand and cached on disk, shared by every session. The
+# server is started with the process by serve.py, so that the load balancer
+# finds it healthy before any session; running app.py directly starts it here.
+tile_server()
+
+
+def slide_viewer(slide_id: str, height: int = 700) -> None:
+    # Unless told otherwise, tiles come from the host serving the page, on the
+    # tile server's port.
+    public_url = json.dumps(os.environ.get('DZI_PUBLIC_URL', ''))
+    components.html(f'''
+        <div id="viewer" style="width: 100%; height: {height}px; background: black;"></div>
+        <script src="{OPENSEADRAGON_URL}openseadragon.min.js"></script>
+        <script>
+            const page = window.parent.location;
+            const base = {public_url} || `${{page.protocol}}//${{page.hostname}}:{DZI_PORT}`;
+            OpenSeadragon({{
+                id: 'viewer',
+                prefixUrl: '{OPENSEADRAGON_URL}images/',
+                tileSources: `${{base}}/slides/{slide_id}.dzi`,
+                showNavigator: true,
+                maxZoomPixelRatio: 2,
+            }});
+        </script>
+    ''', height=height + 10)
+
+
+view = st.sidebar.radio('View', ['Image', 'Whole slide'])
+
+if view == 'Whole slide':
+    slides = sorted(f for f in os.listdir(SLIDE_DIR) if f.lower().endswith(SLIDE_EXTENSIONS)) \
+        if os.path.isdir(SLIDE_DIR) else []
+    if not slides:
+        st.info(f'No slides found in {SLIDE_DIR}. Set SLIDE_DIR to the directory that holds them.')
+    else:
+        slide_file = st.selectbox('Slide', slides)
+        detections_file = st.file_uploader('Detections (JSON, as written by save_detections)', type='json')
+        detections = load_detections(detections_file) if detections_file is not None else []
+
+        slide_id = tile_server().add_slide(os.path.join(SLIDE_DIR, slide_file), detections)
+        slide_viewer(slide_id)
+        st.caption(f'{len(detections)} detections')
+
+uploaded_file = None
+if view == 'Image':
+    # Without an override, no MinConfidence is sent and the model applies its
+    # own per-label thresholds.
+    min_confidence = None
+    if st.checkbox('Override minimum confidence'):
+        min_confidence = st.slider('Minimum confidence', min_value=0, max_value=100, value=50)
+    uploaded_file = st.file_uploader('Image file')
 if uploaded_file is not None:
-    image_bytes = uploaded_file.read()
-    result = rek_client.detect_custom_labels(
-        ProjectVersionArn=PROJECT_VERSION_ARN,
-        Image={
-            'Bytes': image_bytes
-        }
-    )
+    image_bytes = uploaded_file.getvalue()
+    instrumentation.count('app.uploads')
+    with instrumentation.timer('app.detect'):
+        result = detection_cache.get_or_detect(
+            image_bytes,
+            detector.model_id,
+            min_confidence,
+            lambda: detector.detect(image_bytes, min_confidence),
+        )
     img = Image.open(io.BytesIO(image_bytes))
     draw = ImageDraw.Draw(img)
 
@@ -37,4 +131,6 @@ if uploaded_file is not None:
         draw.rectangle([l, t, l + w, t + h], outline=(0, 0, 255, 255), width=5)
 
     st_img = st.image(img)
+    st.caption(f"Detection cache: {detection_cache.stats}")
+    st.caption(f"Detector: {detector.stats}")
 
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryTier:
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskTier:
+    """Detection results as JSON files in a directory, which may be shared by several processes.
+
+    Other processes can evict any entry at any time, so a file that disappears,
+    or any other file system error, makes the lookup a miss rather than an error.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 ttl: float = 24 * 3600,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 scan_interval: float = 60):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.scan_interval = scan_interval
+        self._lock = threading.Lock()
+        # Size of the directory at the last scan, plus what was written since.
+        # Other processes' writes are only seen by the next scan, which happens
+        # at least every `scan_interval` seconds.
+        self._size = None
+        self._scanned = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Reading refreshes the entry, so eviction removes the least recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_bytes or time.time() - self._scanned > self.scan_interval:
+                self._evict()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        now = time.time()
+        entries = []
+        try:
+            scan = list(os.scandir(self.directory))
+        except OSError:
+            return
+
+        for entry in scan:
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed by another process since the directory was listed.
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+        self._size = total
+        self._scanned = now
+
+
+class RedisTier:
+
+    def __init__(self, url: str, ttl: float = 24 * 3600, prefix: str = 'rek-detections:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required to use a Redis detection cache')
+
+        # Size-based eviction is left to the server (maxmemory + an LRU policy).
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+
+class DetectionCache:
+
+    def __init__(self, max_entries: int = 256, shared=None):
+        self.memory = MemoryTier(max_entries)
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image_bytes: bytes, project_version_arn: str, min_confidence: Optional[float]) -> str:
+        # An unset minimum confidence (the model's own thresholds) is keyed as
+        # 'unset', apart from every explicit value.
+        confidence = 'unset' if min_confidence is None else f'{float(min_confidence):g}'
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return hashlib.sha256(f'{digest}|{project_version_arn}|{confidence}'.encode('utf-8')).hexdigest()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get_or_detect(self,
+                      image_bytes: bytes,
+                      project_version_arn: str,
+                      min_confidence: Optional[float],
+                      detect: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+
+        key = self.key(image_bytes, project_version_arn, min_confidence)
+
+        result = self.memory.get(key)
+        if result is not None:
+            self._count('hits')
+            return result
+
+        if self.shared is not None:
+            result = self.shared.get(key)
+            if result is not None:
+                self._count('shared_hits')
+                self.memory.put(key, result)
+                return result
+
+        self._count('misses')
+        result = detect()
+
+        # Only keep what the app uses; the response metadata is per request.
+        result = {'CustomLabels': result['CustomLabels']}
+        self.memory.put(key, result)
+        if self.shared is not None:
+            self.shared.put(key, result)
+
+        return result
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses}
+
+
+def cache_from_environment() -> DetectionCache:
+    ttl = float(os.environ.get('DETECTION_CACHE_TTL', 24 * 3600))
+    shared = None
+    if os.environ.get('DETECTION_CACHE_REDIS_URL'):
+        shared = RedisTier(os.environ['DETECTION_CACHE_REDIS_URL'], ttl=ttl)
+    elif os.environ.get('DETECTION_CACHE_DIR'):
+        shared = DiskTier(os.environ['DETECTION_CACHE_DIR'],
+                          ttl=ttl,
+                          max_bytes=int(os.environ.get('DETECTION_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+
+    return DetectionCache(max_entries=int(os.environ.get('DETECTION_CACHE_MAX_ENTRIES', 256)), shared=shared)
@@ -0,0 +1,26 @@
+"""Starts the Deep Zoom tile server, then runs the Streamlit app in the same process.
+
+The load balancer health-checks the tile port as soon as the task starts, long
+before a session first runs the app script, so the tile server cannot wait for
+the app to start it. The app gets the same server from `tile_server()`.
+"""
+import os
+import sys
+
+from streamlit.web import cli
+
+from deepzoom import TileServer, shared_tile_server
+
+DZI_PORT = int(os.environ.get('DZI_PORT', 8502))
+DZI_CACHE_DIR = os.environ.get('DZI_CACHE_DIR', '/tmp/dzi_tiles')
+DZI_MAX_SLIDES = int(os.environ.get('DZI_MAX_SLIDES', 32))
+
+
+def tile_server() -> TileServer:
+    return shared_tile_server(DZI_PORT, cache_dir=DZI_CACHE_DIR, max_slides=DZI_MAX_SLIDES)
+
+
+if __name__ == '__main__':
+    tile_server()
+    sys.argv = ['streamlit', 'run'] + (sys.argv[1:] or ['app.py'])
+    sys.exit(cli.main())
@@ -0,0 +1,146 @@
+import math
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from boxes import BoxArray
+
+# Area of one high-power field, and the 10 HPF region used for the mitotic count
+# in MITOS_WSI_CMC, in square millimeters. The region is a 4:3 rectangle.
+HPF_AREA_MM2 = 0.237
+MITOTIC_COUNT_AREA_MM2 = 10 * HPF_AREA_MM2
+
+
+class Hotspot(NamedTuple):
+    # Center, size and rotation (degrees, counter-clockwise) of the window, in
+    # level-0 pixels.
+    x: float
+    y: float
+    width: float
+    height: float
+    angle: float
+    count: int
+    # Window corners in level-0 pixels, clockwise from the top-left one.
+    corners: np.ndarray
+    # Count of the unrotated window whose top-left corner is at
+    # `origin + (col, row) * cell_size`, for every cell of the density grid.
+    heatmap: np.ndarray
+    origin: Tuple[float, float]
+    cell_size: float
+
+
+def centroids(detections) -> np.ndarray:
+    # Accepts a BoxArray (e.g. the ground truth from `get_slides`), a list of
+    # `Detection`s, or an N x 2 array of points.
+    if isinstance(detections, BoxArray):
+        return detections.centers()
+
+    if len(detections) > 0 and hasattr(detections[0], 'left'):
+        boxes = np.array([[d.left, d.top, d.right, d.bottom] for d in detections], dtype=np.float64)
+        return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+
+    return np.asarray(detections, dtype=np.float64).reshape(-1, 2)
+
+
+def window_size(area_mm2: float, mpp: float, aspect: float = 4 / 3) -> Tuple[float, float]:
+    # Width and height in pixels of a rectangle of `area_mm2` with the given
+    # width / height ratio, at `mpp` microns per pixel.
+    area_px = area_mm2 * 1e6 / mpp ** 2
+    height = math.sqrt(area_px / aspect)
+    return height * aspect, height
+
+
+def density_grid(points: np.ndarray,
+                 cell_size: float,
+                 origin: Tuple[float, float],
+                 shape: Tuple[int, int]) -> np.ndarray:
+    # Number of points in each cell, for a grid of `shape` (rows, columns).
+    rows, cols = shape
+    cells = np.floor((points - np.asarray(origin)) / cell_size).astype(np.int64)
+    inside = (cells[:, 0] >= 0) & (cells[:, 0] < cols) & (cells[:, 1] >= 0) & (cells[:, 1] < rows)
+    cells = cells[inside]
+
+    return np.bincount(cells[:, 1] * cols + cells[:, 0], minlength=rows * cols).reshape(rows, cols)
+
+
+def window_counts(grid: np.ndarray, window_cols: int, window_rows: int) -> np.ndarray:
+    # Sum over every window_rows x window_cols window of the grid, indexed by
+    # its top-left cell, from a summed-area table: four lookups per window.
+    rows, cols = grid.shape
+    s = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+    s[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+
+    # Windows may run past the bottom and right edges, where there are no points.
+    y0, x0 = np.arange(rows)[:, None], np.arange(cols)[None, :]
+    y1, x1 = np.minimum(y0 + window_rows, rows), np.minimum(x0 + window_cols, cols)
+
+    return s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0]
+
+
+def _rotation(angle: float) -> np.ndarray:
+    theta = math.radians(angle)
+    return np.array([[math.cos(theta), -math.sin(theta)],
+                     [math.sin(theta), math.cos(theta)]])
+
+
+def _search(points: np.ndarray, width: float, height: float, cell_size: float):
+    # Best window for axis-aligned points: the grid starts at the points' extent,
+    # so its size depends on where the points are, not on the slide size.
+    origin = points.min(axis=0) - cell_size
+    cols, rows = (np.ceil((points.max(axis=0) - origin) / cell_size).astype(np.int64) + 1).tolist()
+
+    grid = density_grid(points, cell_size, origin, (rows, cols))
+    counts = window_counts(grid, max(1, int(round(width / cell_size))), max(1, int(round(height / cell_size))))
+
+    row, col = np.unravel_index(np.argmax(counts), counts.shape)
+    left, top = origin + np.array([col, row]) * cell_size
+
+    # Count the points in the exact window, rather than in its cell-aligned
+    # approximation.
+    inside = ((points[:, 0] >= left) & (points[:, 0] < left + width) &
+              (points[:, 1] >= top) & (points[:, 1] < top + height))
+
+    return int(inside.sum()), left, top, counts, origin
+
+
+def find_hotspot(detections,
+                 mpp: float = 0.25,
+                 area_mm2: float = MITOTIC_COUNT_AREA_MM2,
+                 aspect: float = 4 / 3,
+                 cell_size: Optional[float] = None,
+                 rotations: int = 1) -> Hotspot:
+    """Window of `area_mm2` with the most detections, with `rotations` orientations tried over 180 degrees.
+
+    `detections` are in level-0 pixels; `mpp` is the slide's level-0 resolution
+    (`SlideContainer.mpp`). The window position is found on a grid of
+    `cell_size` pixels, a tenth of the window height by default.
+    """
+    points = centroids(detections)
+    width, height = window_size(area_mm2, mpp, aspect)
+    cell_size = height / 10 if cell_size is None else cell_size
+
+    if len(points) == 0:
+        corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+        return Hotspot(width / 2, height / 2, width, height, 0.0, 0, corners,
+                       np.zeros((0, 0), dtype=np.int64), (0.0, 0.0), cell_size)
+
+    best, heatmap, heatmap_origin = None, None, None
+    for angle in np.arange(rotations) * 180 / rotations:
+        # Rotating the points by -angle turns a window rotated by `angle` into an
+        # axis-aligned one.
+        rotation = _rotation(angle)
+        rotated = points @ rotation
+        count, left, top, counts, origin = _search(rotated, width, height, cell_size)
+
+        if heatmap is None:
+            heatmap, heatmap_origin = counts, origin
+        if best is None or count > best[0]:
+            best = (count, angle, rotation, left, top)
+
+    count, angle, rotation, left, top = best
+    corners = np.array([[left, top], [left + width, top], [left + width, top + height], [left, top + height]])
+    corners = corners @ rotation.T
+    x, y = corners.mean(axis=0)
+
+    return Hotspot(float(x), float(y), width, height, float(angle), count, corners,
+                   heatmap, tuple(heatmap_origin.tolist()), cell_size)
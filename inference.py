@@ -0,0 +1,283 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import io
+import json
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import instrumentation
+
+
+class Detection(NamedTuple):
+    left: float
+    top: float
+    right: float
+    bottom: float
+    label: str
+    confidence: float
+
+
+class TileResult(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+    detections: List[Detection]
+
+
+class StubRekognitionClient:
+    """Offline stand-in for the Rekognition client.
+
+    `detector` receives the decoded tile as a numpy array and returns a list of
+    `CustomLabels` entries, in the same shape Rekognition would return them.
+    """
+
+    def __init__(self, detector: Optional[Callable[[np.ndarray], List[Dict[str, Any]]]] = None):
+        self.detector = detector
+        self.calls = 0
+
+    def detect_custom_labels(self, ProjectVersionArn: str, Image: Dict[str, bytes],
+                             MinConfidence: Optional[float] = None, **kwargs):
+        self.calls += 1
+        labels = []
+        if self.detector is not None:
+            tile = np.array(_decode(Image['Bytes']))
+            labels = [label for label in self.detector(tile)
+                      if MinConfidence is None or label['Confidence'] >= MinConfidence]
+
+        return {'CustomLabels': labels}
+
+
+def _decode(image_bytes: bytes):
+    return Image.open(io.BytesIO(image_bytes)).convert('RGB')
+
+
+def _encode(patch: np.ndarray, image_format: str = 'PNG') -> bytes:
+    with instrumentation.timer('inference.encode'):
+        buffer = io.BytesIO()
+        Image.fromarray(patch).save(buffer, format=image_format)
+        return buffer.getvalue()
+
+
+def _axis_positions(length: int, tile: int, stride: int) -> List[int]:
+    if length <= tile:
+        return [0]
+
+    positions = list(range(0, length - tile, stride))
+    # Make sure the last tile is flush with the slide border, instead of running
+    # off the edge or leaving a strip uncovered.
+    positions.append(length - tile)
+
+    return positions
+
+
+def enumerate_tiles(width: int, height: int, tile_size: int = 512, overlap: int = 64) -> List[Tuple[int, int]]:
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f'overlap must be in [0, {tile_size}), got {overlap}')
+
+    stride = tile_size - overlap
+    return [(x, y)
+            for y in _axis_positions(height, tile_size, stride)
+            for x in _axis_positions(width, tile_size, stride)]
+
+
+def tissue_tiles(slide, tiles: List[Tuple[int, int]], tile_size: int, min_tissue: float) -> List[Tuple[int, int]]:
+    # Skip tiles that are mostly glass or background, using the slide's cached
+    # low-resolution tissue mask (level-0 coordinates).
+    xy = np.array(tiles, dtype=np.float64) * slide.down_factor
+    extent = tile_size * slide.down_factor
+    keep = slide.tissue_mask.fractions(xy[:, 0], xy[:, 1], extent, extent) >= min_tissue
+
+    return [tile for tile, k in zip(tiles, keep) if k]
+
+
+def _detect_tile(client,
+                 project_version_arn: str,
+                 slide,
+                 x: int,
+                 y: int,
+                 tile_size: int,
+                 min_confidence: Optional[float],
+                 image_format: str) -> TileResult:
+
+    patch = slide.get_patch(x, y, width=tile_size, height=tile_size)
+    height, width = patch.shape[:2]
+
+    image_bytes = _encode(patch, image_format)
+
+    # Without a minimum confidence, Rekognition applies each label's own
+    # threshold, so MinConfidence is only sent when one is given.
+    kwargs = {} if min_confidence is None else {'MinConfidence': min_confidence}
+    with instrumentation.timer('inference.detect_custom_labels'):
+        response = client.detect_custom_labels(
+            ProjectVersionArn=project_version_arn,
+            Image={
+                'Bytes': image_bytes
+            },
+            **kwargs,
+        )
+
+    # Rekognition returns geometry relative to the tile; convert it to level-0
+    # slide coordinates so detections from different tiles can be compared.
+    down_factor = slide.down_factor
+    detections = []
+    for custom_label in response['CustomLabels']:
+        if 'Geometry' not in custom_label:
+            continue
+
+        geometry = custom_label['Geometry']['BoundingBox']
+        left = (x + geometry['Left'] * width) * down_factor
+        top = (y + geometry['Top'] * height) * down_factor
+        detections.append(Detection(
+            left=left,
+            top=top,
+            right=left + geometry['Width'] * width * down_factor,
+            bottom=top + geometry['Height'] * height * down_factor,
+            label=custom_label['Name'],
+            confidence=custom_label['Confidence'],
+        ))
+
+    return TileResult(x=x, y=y, width=width, height=height, detections=detections)
+
+
+def iter_tile_detections(slide,
+                         client,
+                         project_version_arn: str,
+                         tile_size: int = 512,
+                         overlap: int = 64,
+                         max_workers: int = 8,
+                         min_confidence: Optional[float] = None,
+                         image_format: str = 'PNG',
+                         tiles: Optional[List[Tuple[int, int]]] = None,
+                         min_tissue: float = 0.0) -> Iterator[TileResult]:
+
+    if tiles is None:
+        width, height = slide.metadata.level_dimensions[slide.level]
+        tiles = enumerate_tiles(width, height, tile_size, overlap)
+
+    if min_tissue > 0 and tiles:
+        tiles = tissue_tiles(slide, tiles, tile_size, min_tissue)
+
+    pending = iter(tiles)
+    # Only keep a bounded number of tiles in flight, so that memory stays flat
+    # regardless of slide size.
+    max_in_flight = 2 * max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+
+        def submit_next() -> bool:
+            for x, y in pending:
+                in_flight.add(executor.submit(
+                    _detect_tile, client, project_version_arn, slide, x, y, tile_size, min_confidence, image_format))
+                return True
+            return False
+
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                submit_next()
+                yield future.result()
+
+
+def _overlapping_pairs(boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Every pair (i, j) of intersecting boxes, each pair once: sweep over the boxes
+    # sorted by left edge, where the boxes that may intersect box i are the ones
+    # that start between its left and right edges.
+    order = np.argsort(boxes[:, 0], kind='stable')
+    lefts = boxes[order, 0]
+    ends = np.searchsorted(lefts, boxes[order, 2], side='left')
+    counts = np.maximum(ends - np.arange(len(order)) - 1, 0)
+
+    first = np.repeat(np.arange(len(order)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i, j = order[first], order[first + 1 + offsets]
+
+    intersect = (boxes[i, 1] < boxes[j, 3]) & (boxes[j, 1] < boxes[i, 3])
+    return i[intersect], j[intersect]
+
+
+def merge_detections(detections: List[Detection], overlap_threshold: float = 0.5) -> List[Detection]:
+    if not detections:
+        return []
+
+    boxes = np.array([[d.left, d.top, d.right, d.bottom] for d in detections], dtype=np.float64)
+    scores = np.array([d.confidence for d in detections], dtype=np.float64)
+    labels = np.array([d.label for d in detections])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    # Only boxes that intersect can suppress each other, so the overlaps are
+    # computed for those pairs only, instead of for every pair on the slide.
+    i, j = _overlapping_pairs(boxes)
+    iw = np.minimum(boxes[i, 2], boxes[j, 2]) - np.maximum(boxes[i, 0], boxes[j, 0])
+    ih = np.minimum(boxes[i, 3], boxes[j, 3]) - np.maximum(boxes[i, 1], boxes[j, 1])
+
+    # Compare against the smaller of the two boxes rather than the union: a
+    # figure cut by a tile border yields a partial box that is mostly contained
+    # in the full one found by the neighbouring tile.
+    overlap = iw * ih / np.maximum(np.minimum(areas[i], areas[j]), 1e-9)
+    suppress = (overlap >= overlap_threshold) & (labels[i] == labels[j])
+    i, j = np.concatenate([i[suppress], j[suppress]]), np.concatenate([j[suppress], i[suppress]])
+
+    # Neighbours of box k are neighbours[starts[k]:starts[k + 1]].
+    by_box = np.argsort(i, kind='stable')
+    neighbours = j[by_box]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(i, minlength=len(boxes)))])
+
+    # Greedy, by decreasing confidence: a kept box suppresses its neighbours,
+    # suppressed boxes suppress nothing.
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for best in np.argsort(-scores, kind='stable').tolist():
+        if suppressed[best]:
+            continue
+        keep.append(best)
+        suppressed[neighbours[starts[best]:starts[best + 1]]] = True
+
+    return [detections[k] for k in keep]
+
+
+def detect_slide(slide,
+                 client,
+                 project_version_arn: str,
+                 tile_size: int = 512,
+                 overlap: int = 64,
+                 max_workers: int = 8,
+                 min_confidence: Optional[float] = None,
+                 overlap_threshold: float = 0.5,
+                 progress: Optional[Callable[[TileResult], None]] = None,
+                 min_tissue: float = 0.0) -> List[Detection]:
+
+    detections = []
+    for result in iter_tile_detections(slide, client, project_version_arn,
+                                       tile_size=tile_size,
+                                       overlap=overlap,
+                                       max_workers=max_workers,
+                                       min_confidence=min_confidence,
+                                       min_tissue=min_tissue):
+        detections.extend(result.detections)
+        if progress is not None:
+            progress(result)
+
+    return merge_detections(detections, overlap_threshold)
+
+
+def save_detections(path: str, detections: List[Detection]) -> None:
+    # Level-0 coordinates, one object per detection, as read by `load_detections`
+    # and the slide viewer.
+    with open(path, 'w') as f:
+        json.dump([d._asdict() for d in detections], f)
+
+
+def load_detections(f) -> List[Detection]:
+    # `f` is a path or an open file.
+    if isinstance(f, str):
+        with open(f) as fp:
+            return load_detections(fp)
+
+    return [Detection(**d) for d in json.load(f)]
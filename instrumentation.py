@@ -0,0 +1,353 @@
+"""Per-stage timers and counters for the data and inference pipeline.
+
+Instrumentation is off by default; `timer` then returns a shared no-op context
+manager and `count` returns immediately, so the hooks left in the pipeline cost
+a function call each. Turn it on with `enable`, or `configure_from_environment`:
+
+    INSTRUMENTATION_ENABLED=1
+    INSTRUMENTATION_TRACE=trace.json        # Chrome trace events, written at exit
+    INSTRUMENTATION_PROFILE_EVERY=100       # cProfile one in every 100 timed sections
+    INSTRUMENTATION_PROFILE=profile.pstats  # where the profile is written at exit
+    INSTRUMENTATION_PROMETHEUS_PORT=9100    # serve /metrics
+
+The trace opens in chrome://tracing or https://ui.perfetto.dev.
+"""
+import atexit
+import bisect
+import cProfile
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import pstats
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Histogram bucket upper bounds in seconds, from 100 us to ~100 s.
+BUCKETS = [1e-4 * 2 ** i for i in range(21)]
+
+
+class _Timing:
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, other: list) -> None:
+        count, total, minimum, maximum, buckets = other
+        self.count += count
+        self.total += total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+        self.buckets = [a + b for a, b in zip(self.buckets, buckets)]
+
+    def as_list(self) -> list:
+        return [self.count, self.total, self.min, self.max, self.buckets]
+
+
+class Registry:
+    """Timings, counters and, when tracing, the individual timed sections of this process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.max_events = 1_000_000
+        self.profile_every = 0
+        self.timings: Dict[str, _Timing] = {}
+        self.counters: Dict[str, float] = {}
+        self.events: List[dict] = []
+        self.dropped_events = 0
+        self.profile: Optional[pstats.Stats] = None
+        self._sections = 0
+        self._lock = threading.Lock()
+        # cProfile allows one active profiler at a time, across all threads.
+        self._profile_lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+            self.events = []
+            self.dropped_events = 0
+            self.profile = None
+            self._sections = 0
+
+    def record(self, name: str, start: float, seconds: float) -> None:
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = _Timing()
+            timing.record(seconds)
+
+            if self.trace:
+                if len(self.events) < self.max_events:
+                    self.events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6,
+                                        'pid': os.getpid(), 'tid': threading.get_ident()})
+                else:
+                    self.dropped_events += 1
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def start_profile(self) -> Optional[cProfile.Profile]:
+        with self._lock:
+            self._sections += 1
+            sample = self._sections % self.profile_every == 0
+        if not sample or not self._profile_lock.acquire(blocking=False):
+            return None
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler (a debugger, or the user's own) is already active.
+            self._profile_lock.release()
+            return None
+        return profiler
+
+    def stop_profile(self, profiler: cProfile.Profile) -> None:
+        profiler.disable()
+        self._profile_lock.release()
+        with self._lock:
+            if self.profile is None:
+                self.profile = pstats.Stats(profiler)
+            else:
+                self.profile.add(profiler)
+
+    def collect(self) -> Optional[dict]:
+        # Takes everything recorded so far out of the registry, so that worker
+        # processes can send their measurements back with their results.
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            snapshot = {
+                'timings': {name: timing.as_list() for name, timing in self.timings.items()},
+                'counters': self.counters,
+                'events': self.events,
+            }
+            self.timings, self.counters, self.events = {}, {}, []
+
+        return snapshot
+
+    def merge(self, snapshot: Optional[dict]) -> None:
+        if snapshot is None or not self.enabled:
+            return
+
+        with self._lock:
+            for name, values in snapshot['timings'].items():
+                self.timings.setdefault(name, _Timing()).merge(values)
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            if self.trace:
+                room = max(0, self.max_events - len(self.events))
+                self.events.extend(snapshot['events'][:room])
+                self.dropped_events += max(0, len(snapshot['events']) - room)
+
+
+registry = Registry()
+
+
+class _Timer:
+
+    __slots__ = ('name', 'start', 'profiler')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> '_Timer':
+        self.profiler = registry.start_profile() if registry.profile_every else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        end = time.perf_counter()
+        if self.profiler is not None:
+            registry.stop_profile(self.profiler)
+        registry.record(self.name, self.start, end - self.start)
+        return False
+
+
+class _NullTimer:
+
+    __slots__ = ()
+
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str):
+    return _Timer(name) if registry.enabled else _NULL_TIMER
+
+
+def timed(name: str) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            with _Timer(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1) -> None:
+    if registry.enabled:
+        registry.count(name, value)
+
+
+def enable(trace: bool = False, profile_every: int = 0, max_events: int = 1_000_000) -> None:
+    registry.trace = trace
+    registry.profile_every = profile_every
+    registry.max_events = max_events
+    registry.enabled = True
+
+
+def settings() -> Optional[Dict[str, Any]]:
+    # What `enable` was called with, to set up worker processes the same way.
+    if not registry.enabled:
+        return None
+    return {'trace': registry.trace, 'profile_every': registry.profile_every, 'max_events': registry.max_events}
+
+
+def disable() -> None:
+    registry.enabled = False
+
+
+def reset() -> None:
+    registry.reset()
+
+
+def collect() -> Optional[dict]:
+    return registry.collect()
+
+
+def merge(snapshot: Optional[dict]) -> None:
+    registry.merge(snapshot)
+
+
+def summary() -> Dict[str, Any]:
+    with registry._lock:
+        timings = {name: {
+            'count': t.count,
+            'total_s': t.total,
+            'mean_ms': t.total / t.count * 1000 if t.count else 0.0,
+            'min_ms': t.min * 1000 if t.count else 0.0,
+            'max_ms': t.max * 1000,
+        } for name, t in sorted(registry.timings.items())}
+        return {'timings': timings, 'counters': dict(sorted(registry.counters.items()))}
+
+
+def write_trace(path: str) -> None:
+    with registry._lock:
+        trace = {
+            'traceEvents': list(registry.events),
+            'displayTimeUnit': 'ms',
+            'otherData': {'dropped_events': registry.dropped_events},
+        }
+    trace['otherData'].update(summary())
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(trace, f)
+    os.replace(tmp_path, path)
+
+
+def write_profile(path: str) -> bool:
+    # Only the sections profiled in this process; worker processes keep theirs.
+    with registry._lock:
+        if registry.profile is None:
+            return False
+        registry.profile.dump_stats(path)
+    return True
+
+
+def _metric_name(name: str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def prometheus_text() -> str:
+    lines = [
+        '# TYPE pipeline_section_seconds histogram',
+    ]
+    with registry._lock:
+        for name, t in sorted(registry.timings.items()):
+            labels = f'section="{name}"'
+            cumulative = 0
+            for bound, n in zip(BUCKETS, t.buckets):
+                cumulative += n
+                lines.append(f'pipeline_section_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+            lines.append(f'pipeline_section_seconds_bucket{{{labels},le="+Inf"}} {t.count}')
+            lines.append(f'pipeline_section_seconds_sum{{{labels}}} {t.total}')
+            lines.append(f'pipeline_section_seconds_count{{{labels}}} {t.count}')
+
+        for name, value in sorted(registry.counters.items()):
+            metric = f'pipeline_{_metric_name(name)}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_prometheus(port: int, address: str = '') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='instrumentation-metrics', daemon=True).start()
+    return server
+
+
+def configure_from_environment() -> Optional[ThreadingHTTPServer]:
+    trace_path = os.environ.get('INSTRUMENTATION_TRACE')
+    port = os.environ.get('INSTRUMENTATION_PROMETHEUS_PORT')
+    profile_every = int(os.environ.get('INSTRUMENTATION_PROFILE_EVERY', 0))
+    enabled = os.environ.get('INSTRUMENTATION_ENABLED', '').strip().lower() in ('1', 'true', 'yes')
+    if not (enabled or trace_path or port or profile_every):
+        return None
+
+    enable(trace=bool(trace_path), profile_every=profile_every)
+    if trace_path:
+        atexit.register(write_trace, trace_path)
+    if profile_every:
+        atexit.register(write_profile, os.environ.get('INSTRUMENTATION_PROFILE', 'profile.pstats'))
+
+    return serve_prometheus(int(port)) if port else None
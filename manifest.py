@@ -0,0 +1,156 @@
+import datetime
+import glob
+import gzip
+import json
+import os
+from typing import Dict, List, Optional, Set
+
+import instrumentation
+
+
+class ManifestWriter:
+    """Streams SageMaker Ground Truth object detection lines to one or more manifest files.
+
+    With `max_shard_bytes` set, `manifest.json` becomes `manifest-00000.json`,
+    `manifest-00001.json`, ... each holding at most that many (uncompressed)
+    bytes, and with `compress=True` every file is gzipped.
+    In append mode, existing lines are kept and `source-ref`s already present are
+    not written again, so an interrupted export can be resumed.
+    """
+
+    def __init__(self,
+                 path: str,
+                 bucket_name: str,
+                 channel: str,
+                 size: int,
+                 class_map: Dict[int, str],
+                 job_name: str = 'rek-pathology',
+                 prefix: str = 'data',
+                 max_shard_bytes: Optional[int] = None,
+                 compress: bool = False,
+                 append: bool = False):
+
+        self.path = path
+        self.channel = channel
+        self.max_shard_bytes = max_shard_bytes
+        self.compress = compress
+
+        # Everything except the source-ref, the annotations and their objects is
+        # the same for every line of a job, so it is serialized only once.
+        self._source_ref_prefix = f's3://{bucket_name}/{prefix}/{channel}/'
+        self._image_size = json.dumps([{'width': size, 'height': size, 'depth': 3}])
+        self._metadata_tail = json.dumps({
+            'class-map': {x: str(name) for x, name in class_map.items()},
+            'type': 'groundtruth/object-detection',
+            'human-annotated': 'yes',
+            'creation-date': datetime.datetime.now().isoformat(),
+            'job-name': job_name,
+        })[1:-1]
+
+        self._source_refs: Set[str] = set()
+        self._shard = 0
+        self._shard_bytes = 0
+        self._file = None
+        self.written = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        existing = self.shard_paths()
+        if append and existing:
+            for shard_path in existing:
+                lines = self._read_complete_lines(shard_path)
+                self._source_refs.update(json.loads(line)['source-ref'] for line in lines)
+                self._shard_bytes = sum(len(line) for line in lines)
+
+            self._shard = len(existing) - 1
+        else:
+            for shard_path in existing:
+                os.remove(shard_path)
+
+    def _open(self, path: str, mode: str):
+        return gzip.open(path, mode) if self.compress else open(path, mode)
+
+    def _read_complete_lines(self, path: str) -> List[bytes]:
+        lines, truncated = [], False
+        try:
+            with self._open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        truncated = True
+                        break
+                    if line.strip():
+                        lines.append(line)
+        except EOFError:
+            truncated = True
+
+        # An export that was killed can leave a partial last line (or gzip member)
+        # behind; rewrite the file with the complete lines only.
+        if truncated:
+            with self._open(path + '.tmp', 'wb') as f:
+                f.writelines(lines)
+            os.replace(path + '.tmp', path)
+
+        return lines
+
+    def _shard_path(self, shard: int) -> str:
+        root, ext = os.path.splitext(self.path)
+        path = f'{root}-{shard:05d}{ext}' if self.max_shard_bytes else self.path
+        return path + '.gz' if self.compress else path
+
+    def shard_paths(self) -> List[str]:
+        if not self.max_shard_bytes:
+            path = self._shard_path(0)
+            return [path] if os.path.exists(path) else []
+
+        root, ext = os.path.splitext(self.path)
+        return sorted(glob.glob(f'{glob.escape(root)}-[0-9][0-9][0-9][0-9][0-9]{ext}' + ('.gz' if self.compress else '')))
+
+    def source_ref(self, filename: str) -> str:
+        return self._source_ref_prefix + filename
+
+    def __contains__(self, filename: str) -> bool:
+        return self.source_ref(filename) in self._source_refs
+
+    def format_line(self, filename: str, annotations: List[dict]) -> str:
+        objects = ', '.join(['{"confidence": 1}'] * len(annotations))
+
+        # Same layout and key order as json.dumps on the full dictionary.
+        return (f'{{"source-ref": {json.dumps(self.source_ref(filename))}, '
+                f'"bounding-box": {{"image_size": {self._image_size}, "annotations": {json.dumps(annotations)}}}, '
+                f'"bounding-box-metadata": {{"objects": [{objects}], {self._metadata_tail}}}}}')
+
+    def write(self, filename: str, annotations: List[dict]) -> bool:
+        source_ref = self.source_ref(filename)
+        if source_ref in self._source_refs:
+            return False
+
+        with instrumentation.timer('manifest.serialize'):
+            line = (self.format_line(filename, annotations) + '\n').encode('utf-8')
+
+        if self.max_shard_bytes and self._shard_bytes > 0 and self._shard_bytes + len(line) > self.max_shard_bytes:
+            self.close()
+            self._shard += 1
+            self._shard_bytes = 0
+
+        if self._file is None:
+            self._file = self._open(self._shard_path(self._shard), 'ab')
+
+        self._file.write(line)
+        self._shard_bytes += len(line)
+        self._source_refs.add(source_ref)
+        self.written += 1
+
+        return True
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'ManifestWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,128 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from PIL import Image
+from tqdm.auto import tqdm
+
+from boxes import BoxArray
+from manifest import ManifestWriter
+
+
+class PatchStore:
+    """Extracted patches in one memory-mapped N x H x W x 3 uint8 array, plus their index.
+
+    The index holds, for every patch, the slide it came from, its position in
+    the slide and its channel, and the bounding boxes inside it in patch
+    coordinates. Re-exporting images or manifests from a store never touches
+    the slide files again.
+    """
+
+    def __init__(self, root: str, mode: str = 'r'):
+        self.root = root
+        with open(os.path.join(root, 'store.json')) as f:
+            meta = json.load(f)
+
+        self.shape = (meta['count'], meta['height'], meta['width'], 3)
+        self.patches = np.memmap(os.path.join(root, 'patches.u8'), dtype=np.uint8, mode=mode, shape=self.shape)
+
+        with np.load(os.path.join(root, 'index.npz')) as index:
+            self.slide_ids = index['slide_ids']
+            self.xs = index['xs']
+            self.ys = index['ys']
+            self.channels = index['channels']
+            self.box_offsets = index['box_offsets']
+            self.boxes_array = BoxArray.from_rows(index['boxes'], index['labels'])
+
+    @classmethod
+    def create(cls,
+               root: str,
+               slide_ids: Sequence[int],
+               xs: Sequence[int],
+               ys: Sequence[int],
+               channels: Sequence[str],
+               size: int) -> 'PatchStore':
+
+        os.makedirs(root, exist_ok=True)
+        count = len(slide_ids)
+        with open(os.path.join(root, 'store.json'), 'w') as f:
+            json.dump({'count': count, 'height': size, 'width': size}, f)
+
+        # Allocate the (sparse) file up front, so workers can open it and write
+        # their patch in place.
+        np.memmap(os.path.join(root, 'patches.u8'), dtype=np.uint8, mode='w+', shape=(count, size, size, 3)).flush()
+
+        cls._save_index(root, slide_ids, xs, ys, channels, [BoxArray.empty()] * count)
+
+        return cls(root, mode='r+')
+
+    @staticmethod
+    def _save_index(root: str, slide_ids, xs, ys, channels, boxes: List[BoxArray]) -> None:
+        all_boxes = BoxArray.concatenate(boxes)
+        offsets = np.zeros(len(boxes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in boxes])
+
+        np.savez(os.path.join(root, 'index.npz'),
+                 slide_ids=np.asarray(slide_ids, dtype=np.int32),
+                 xs=np.asarray(xs, dtype=np.int32),
+                 ys=np.asarray(ys, dtype=np.int32),
+                 channels=np.asarray(channels, dtype=str),
+                 box_offsets=offsets,
+                 boxes=all_boxes.as_array(),
+                 labels=all_boxes.labels)
+
+    def set_boxes(self, boxes: List[BoxArray]) -> None:
+        self._save_index(self.root, self.slide_ids, self.xs, self.ys, self.channels, boxes)
+        self.box_offsets = np.zeros(len(boxes) + 1, dtype=np.int64)
+        self.box_offsets[1:] = np.cumsum([len(b) for b in boxes])
+        self.boxes_array = BoxArray.concatenate(boxes)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.patches[idx]
+
+    def boxes(self, idx: int) -> BoxArray:
+        return self.boxes_array[self.box_offsets[idx]:self.box_offsets[idx + 1]]
+
+    def indices(self, channel: Optional[str] = None) -> np.ndarray:
+        return np.arange(len(self)) if channel is None else np.flatnonzero(self.channels == channel)
+
+    def write_images(self,
+                     output_dir: str,
+                     manifests: Optional[Dict[str, ManifestWriter]] = None,
+                     indices: Optional[Sequence[int]] = None,
+                     channels: Optional[Sequence[str]] = None,
+                     image_format: str = 'PNG',
+                     **save_options) -> int:
+
+        # `channels` overrides the stored channel per patch, which is all it
+        # takes to re-split a dataset.
+        indices = self.indices() if indices is None else indices
+        channels = self.channels[indices] if channels is None else channels
+        extension = 'jpg' if image_format.upper() == 'JPEG' else image_format.lower()
+
+        for channel in set(channels):
+            os.makedirs(os.path.join(output_dir, channel), exist_ok=True)
+
+        written = 0
+        for idx, channel in tqdm(zip(indices, channels), total=len(indices), desc='Writing images...'):
+            filename = f'slide_{idx}.{extension}'
+            if manifests is not None and filename in manifests[channel]:
+                continue
+
+            Image.fromarray(self.patches[idx]).save(os.path.join(output_dir, channel, filename),
+                                                    format=image_format, **save_options)
+            if manifests is not None:
+                manifests[channel].write(filename, self.boxes(idx).to_annotations(class_id=1))
+            written += 1
+
+        return written
+
+    def write_manifests(self, manifests: Dict[str, ManifestWriter], image_format: str = 'PNG') -> int:
+        # Manifests only, for images that are already on disk or in S3.
+        extension = 'jpg' if image_format.upper() == 'JPEG' else image_format.lower()
+        return sum(manifests[channel].write(f'slide_{idx}.{extension}', self.boxes(idx).to_annotations(class_id=1))
+                   for idx, channel in zip(self.indices(), self.channels))
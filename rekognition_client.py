@@ -0,0 +1,282 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionError, HTTPClientError
+
+import instrumentation
+
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'TooManyRequestsException',
+}
+
+
+# Server-side failures that botocore's default retry mode would retry.
+TRANSIENT_ERROR_CODES = {
+    'InternalServerError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+
+
+def is_throttling_error(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(error: Exception) -> bool:
+    # Connection failures, read timeouts and 5xx responses.
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    return isinstance(error, ClientError) and (
+        error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES or
+        error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUS_CODES)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows additively and halves on throttling.
+
+    Rekognition quotas are per second, so a burst that exceeds one keeps being
+    throttled for up to a second, whatever the latency of the calls. The limit
+    is therefore halved at most once per `window` seconds, and throttles of
+    calls that started before the last decrease are ignored. Until the first
+    throttle, the limit grows by one per round of successful calls; after it,
+    by at most one per window without throttling.
+    """
+
+    def __init__(self,
+                 initial: int = 4,
+                 minimum: int = 1,
+                 maximum: int = 32,
+                 decrease: float = 0.5,
+                 window: float = 1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.window = window
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = float('-inf')
+        self._last_change = float('-inf')
+        self._condition = threading.Condition()
+
+    def acquire(self) -> int:
+        # Returns the number of decreases so far, to pass back to `release`.
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self.decreases
+
+    def release(self, throttled: Optional[bool], started: Optional[int] = None) -> None:
+        # `throttled=None` frees the slot without any signal about the rate,
+        # e.g. after a server error.
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            current = started is None or started == self.decreases
+            if throttled:
+                if current and now - self._last_decrease >= self.window:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.decreases += 1
+                    self._last_decrease = self._last_change = now
+            elif throttled is not None and current:
+                if self.decreases == 0:
+                    # +1 / limit per success adds roughly one slot per round of calls.
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                elif now - self._last_change >= self.window:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self._last_change = now
+            self._condition.notify_all()
+
+
+class LatencyHistogram:
+
+    # Bucket upper bounds in seconds, log-spaced from 10 ms to ~40 s.
+    BOUNDS = [0.01 * 2 ** (i / 2) for i in range(25)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        bucket = next((i for i, bound in enumerate(self.BOUNDS) if seconds <= bound), len(self.BOUNDS))
+        with self._lock:
+            self.counts[bucket] += 1
+            self.total += seconds
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, q: float) -> float:
+        # Upper bound of the bucket that holds the q-th percentile.
+        count = self.count
+        if count == 0:
+            return 0.0
+        rank, seen = q / 100 * count, 0
+        for bound, n in zip(self.BOUNDS + [float('inf')], self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self) -> Dict[str, float]:
+        count = self.count
+        return {
+            'count': count,
+            'mean': self.total / count if count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class RekognitionClient:
+    """`detect_custom_labels` with rate limiting, adaptive concurrency and jittered retries."""
+
+    def __init__(self,
+                 client=None,
+                 rate: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 initial_concurrency: int = 4,
+                 max_concurrency: int = 32,
+                 max_retries: int = 8,
+                 base_delay: float = 0.1,
+                 max_delay: float = 10.0):
+
+        # Retries are done here, where throttling also feeds the concurrency
+        # limit, so botocore's own retries are turned off; transient errors are
+        # retried here too, with the same backoff.
+        self.client = client if client is not None else boto3.client('rekognition', config=Config(
+            max_pool_connections=max_concurrency,
+            retries={'max_attempts': 1, 'mode': 'standard'},
+            tcp_keepalive=True,
+        ))
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.limiter = AIMDLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency = LatencyHistogram()
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.errors = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def detect_custom_labels(self, **kwargs) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+
+            started = self.limiter.acquire()
+            throttled: Optional[bool] = False
+            start = time.monotonic()
+            try:
+                self._count('calls')
+                with instrumentation.timer('rekognition.call'):
+                    response = self.client.detect_custom_labels(**kwargs)
+                self.latency.record(time.monotonic() - start)
+                return response
+            except (ClientError, BotoCoreError) as e:
+                if not (is_throttling_error(e) or is_transient_error(e)) or attempt == self.max_retries:
+                    self._count('errors')
+                    raise
+                if is_throttling_error(e):
+                    # Only throttling says the rate is too high; other errors
+                    # leave the concurrency limit alone.
+                    throttled = True
+                    self._count('throttles')
+                    instrumentation.count('rekognition.throttles')
+                else:
+                    throttled = None
+                    self._count('retries')
+                    instrumentation.count('rekognition.retries')
+            finally:
+                self.limiter.release(throttled, started)
+
+            # Full jitter keeps throttled callers from retrying in lockstep.
+            time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    async def detect_custom_labels_async(self, **kwargs) -> Dict[str, Any]:
+        # Waiting on the limiter and the backoff happens on the client's own
+        # threads, so the event loop is never blocked.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self.detect_custom_labels(**kwargs))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'throttles': self.throttles,
+            'retries': self.retries,
+            'errors': self.errors,
+            'concurrency_limit': self.limiter.limit,
+            'latency': self.latency.summary(),
+        }
+
+
+class FakeThrottlingClient:
+    """Local stand-in for Rekognition that throttles above a fixed rate of calls per second."""
+
+    def __init__(self, rate: float, latency: float = 0.05, labels: Optional[List[Dict[str, Any]]] = None):
+        self.rate = rate
+        self.latency = latency
+        self.labels = labels or []
+        self._calls: List[float] = []
+        self._lock = threading.Lock()
+
+    def detect_custom_labels(self, **kwargs) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._calls = [t for t in self._calls if now - t < 1.0]
+            throttled = len(self._calls) >= self.rate
+            if not throttled:
+                self._calls.append(now)
+
+        time.sleep(self.latency)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                         'Message': 'Rate exceeded'}}, 'DetectCustomLabels')
+
+        return {'CustomLabels': list(self.labels)}
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+from typing import Dict, NamedTuple, Tuple
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from tqdm.auto import tqdm
+
+MB = 1024 * 1024
+
+
+class SyncResult(NamedTuple):
+    uploaded: int
+    skipped: int
+    uploaded_bytes: int
+
+
+def s3_client(max_workers: int = 16):
+    # One pooled client shared by every upload thread; the pool needs room for
+    # every thread, plus the parts of concurrent multipart uploads.
+    return boto3.client('s3', config=Config(max_pool_connections=max_workers * 2,
+                                            retries={'mode': 'adaptive', 'max_attempts': 10}))
+
+
+def etag(path: str, multipart_threshold: int, multipart_chunksize: int) -> str:
+    # S3 uses the MD5 of the object as ETag for single part uploads, and the MD5
+    # of the concatenated part MD5s followed by the part count for multipart
+    # uploads. Computing it locally lets unchanged objects be skipped from a
+    # single listing, without a HEAD request per object.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size < multipart_threshold:
+            return hashlib.md5(f.read()).hexdigest()
+
+        digests = [hashlib.md5(chunk).digest() for chunk in iter(lambda: f.read(multipart_chunksize), b'')]
+        return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+
+def list_objects(client, bucket: str, prefix: str) -> Dict[str, Tuple[int, str]]:
+    objects = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = (item['Size'], item['ETag'].strip('"'))
+
+    return objects
+
+
+def sync_directory(local_dir: str,
+                   bucket: str,
+                   prefix: str = 'data',
+                   client=None,
+                   max_workers: int = 16,
+                   multipart_threshold: int = 64 * MB,
+                   multipart_chunksize: int = 16 * MB) -> SyncResult:
+
+    client = s3_client(max_workers) if client is None else client
+    transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                     multipart_chunksize=multipart_chunksize,
+                                     max_concurrency=4)
+
+    prefix = prefix.strip('/')
+    remote = list_objects(client, bucket, prefix + '/' if prefix else '')
+
+    files = []
+    for root, _, filenames in os.walk(local_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            relative = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            files.append((path, f'{prefix}/{relative}' if prefix else relative))
+
+    def sync_file(path: str, key: str) -> int:
+        size = os.path.getsize(path)
+        if key in remote:
+            remote_size, remote_etag = remote[key]
+            if remote_size == size and remote_etag == etag(path, multipart_threshold, multipart_chunksize):
+                return -1
+
+        client.upload_file(path, bucket, key, Config=transfer_config)
+        return size
+
+    uploaded, skipped, uploaded_bytes = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(sync_file, path, key) for path, key in files]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Uploading...'):
+            size = future.result()
+            if size < 0:
+                skipped += 1
+            else:
+                uploaded += 1
+                uploaded_bytes += size
+
+    tqdm.write(f'Uploaded {uploaded} files ({uploaded_bytes / MB:.1f} MiB), {skipped} unchanged')
+
+    return SyncResult(uploaded=uploaded, skipped=skipped, uploaded_bytes=uploaded_bytes)
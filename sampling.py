@@ -1,45 +1,66 @@
-from functools import partial
+from functools import lru_cache, partial
 import os
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import openslide
 from pathlib import Path
 from SlideRunner.dataAccess.annotations import *
 from SlideRunner.dataAccess.database import Database
-from tqdm.notebook import tqdm
+from PIL import Image
+from tqdm.auto import tqdm
 
+from annotation_loader import AnnotationTable
+# BoundingBox is re-exported, as code written against the notebook imports it from here.
+from boxes import BoundingBox, BoxArray
+import instrumentation
+from slidepool import handle_pool
+from spatial import GridIndex
+from tilecache import TileCache
+from tissue import TissueMask, cached_tissue_mask
 
-class BoundingBox:
-    
-    def __init__(self, left: int, top: int, right: int, bottom: int):
-        self._left = left
-        self._top = top
-        self._right = right
-        self._bottom = bottom
-    
-    @property
-    def left(self) -> int:
-        return self._left
-    
-    @property
-    def top(self) -> int:
-        return self._top
+# Directory where tissue masks are cached, next to the notebook by default.
+TISSUE_MASK_DIR = 'tissue_masks'
+
+
+# Decoded pixel blocks shared by every SlideContainer of the process. It is off
+# (a budget of 0) unless enabled with `set_tile_cache_budget`, since the budget
+# is held in every process that reads patches, e.g. each data loader worker.
+tile_cache = TileCache(max_bytes=0)
+
+
+def set_tile_cache_budget(max_bytes: int) -> None:
+    tile_cache.resize(max_bytes)
+
+
+class SlideMetadata(NamedTuple):
+    dimensions: Tuple[int, int]
+    level_count: int
+    level_dimensions: Tuple[Tuple[int, int], ...]
+    level_downsamples: Tuple[float, ...]
+    properties: Dict[str, str]
+
+
+@lru_cache(maxsize=None)
+def _slide_metadata(file: str) -> SlideMetadata:
+    slide = handle_pool.get(file)
+    return SlideMetadata(dimensions=slide.dimensions,
+                         level_count=slide.level_count,
+                         level_dimensions=slide.level_dimensions,
+                         level_downsamples=slide.level_downsamples,
+                         properties=dict(slide.properties))
+
+
+def slide_metadata(file) -> SlideMetadata:
+    return _slide_metadata(str(file))
+
+
+# Each mask holds a summed-area table of a few to tens of MB, so only as many
+# are kept as the handle pool holds slides by default.
+@lru_cache(maxsize=handle_pool.maxsize)
+def _slide_tissue_mask(file: str, cache_dir: Optional[str]) -> TissueMask:
+    return cached_tissue_mask(handle_pool.get(file), file, cache_dir)
 
-    @property
-    def right(self) -> int:
-        return self._right
-    
-    @property
-    def bottom(self) -> int:
-        return self._bottom
-    
-    def check_bbox(x_start: int, y_start: int, bbox, size: int = 512) -> bool:
-        return (self._left > x_start and
-                self._right < x_start + size and
-                self._top > y_start and
-                self._bottom < y_start + size)
 
-    
 class SlideContainer():
 
     def __init__(self,
@@ -49,27 +70,101 @@ class SlideContainer():
                  level: int = 0,
                  width: int = 256,
                  height: int = 256,
-                 sample_func: Optional[Callable] = None):
+                 sample_func: Optional[Callable] = None,
+                 index: Optional[GridIndex] = None):
         
         self.file = file
-        self.slide = openslide.open_slide(str(file))
+        self.metadata = slide_metadata(file)
         self.width = width
         self.height = height
-        self.down_factor = self.slide.level_downsamples[level]
+        self.level = self.metadata.level_count - 1 if level is None else level
+        self.down_factor = self.metadata.level_downsamples[self.level]
         self.y = y
         self.annotations = annotations
         self.sample_func = sample_func
+        self.index = index
         self.classes = list(set(self.y[1]))
-        
-        self.level = self.slide.level_count - 1 if level is None else level
+
+    @property
+    def slide(self) -> openslide.OpenSlide:
+        # Slides are opened on first use and shared through a bounded pool, so
+        # only the most recently used ones hold a file descriptor and caches.
+        return handle_pool.get(self.file)
 
     @property
     def shape(self):
         return (self.width, self.height)
 
-    def get_patch(self,  x: int=0, y: int=0):
-         return np.array(self.slide.read_region(location=(int(x * self.down_factor),int(y * self.down_factor)),
-                                                level=self.level, size=(self.width, self.height)))[:, :, :3]
+    @property
+    def tissue_mask(self) -> TissueMask:
+        return _slide_tissue_mask(str(self.file), TISSUE_MASK_DIR)
+
+    def tissue_fraction(self, x: int = 0, y: int = 0, width: Optional[int] = None, height: Optional[int] = None) -> float:
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+
+        # The mask works in level-0 coordinates, patches in the container level.
+        return self.tissue_mask.fraction(x * self.down_factor, y * self.down_factor,
+                                         width * self.down_factor, height * self.down_factor)
+
+    def _read_region(self, level: int, x: int, y: int, width: int, height: int) -> np.ndarray:
+        # `x` and `y` are in the coordinates of `level`. Overlapping windows reuse
+        # decoded blocks from the tile cache instead of decoding the same
+        # compressed tiles again.
+        with instrumentation.timer('slide.read_region'):
+            if tile_cache.max_bytes > 0:
+                return tile_cache.read_region(self.slide, str(self.file), level, x, y, width, height)
+
+            downsample = self.metadata.level_downsamples[level]
+            with instrumentation.timer('slide.decode'):
+                return np.array(self.slide.read_region(location=(int(x * downsample), int(y * downsample)),
+                                                       level=level, size=(width, height)))
+
+    def get_patch(self,  x: int=0, y: int=0, width: Optional[int] = None, height: Optional[int] = None):
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+
+        return self._read_region(self.level, int(x), int(y), width, height)[:, :, :3]
+
+    @property
+    def mpp(self) -> Optional[float]:
+        mpp = self.metadata.properties.get(openslide.PROPERTY_NAME_MPP_X)
+        return float(mpp) if mpp else None
+
+    def best_level(self, downsample: float) -> int:
+        # The lowest resolution level that still has at least the requested
+        # resolution; the small tolerance absorbs rounding in reported downsamples.
+        levels = [i for i, d in enumerate(self.metadata.level_downsamples) if d <= downsample * 1.001]
+        return levels[-1] if levels else 0
+
+    def read_patch(self,
+                   x: int,
+                   y: int,
+                   width: int,
+                   height: int,
+                   downsample: Optional[float] = None,
+                   mpp: Optional[float] = None,
+                   rgb: bool = True,
+                   resample: int = Image.BILINEAR) -> np.ndarray:
+
+        # `x` and `y` are level-0 coordinates; `width` and `height` are the size of
+        # the returned patch at the requested resolution.
+        if mpp is not None:
+            if self.mpp is None:
+                raise ValueError(f'{self.file} does not report its microns per pixel')
+            downsample = mpp / self.mpp
+        downsample = 1.0 if downsample is None else downsample
+
+        level = self.best_level(downsample)
+        level_downsample = self.metadata.level_downsamples[level]
+        scale = downsample / level_downsample
+        read_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+        region = self._read_region(level, int(x // level_downsample), int(y // level_downsample), *read_size)
+        if read_size != (width, height):
+            region = np.array(Image.fromarray(region, 'RGBA').resize((width, height), resample=resample))
+
+        return region[:, :, :3] if rgb else region
 
 
 def sampling_func(y, **kwargs):
@@ -84,18 +179,151 @@ def sampling_func(y, **kwargs):
     yoffset = randint(-h, h) * _random_offset_scale
 
     slide_width, slide_height = level_dimensions[level]
-        
-    xmin, ymin = randint(int(w / 2 - xoffset), slide_width - w), randint(int(h / 2 - yoffset), slide_height - h)
-    
-    return int(xmin - w / 2 + xoffset), int(ymin - h / 2 + yoffset)
-    
+
+    # Optionally reject windows that are mostly glass or background. If none of
+    # `max_tries` windows has enough tissue, the one with the most tissue is
+    # returned, so that callers always get an (x, y) position.
+    tissue_fraction = kwargs.get('tissue_fraction')
+    min_tissue = kwargs.get('min_tissue', 0.0)
+    max_tries = kwargs.get('max_tries', 100)
+
+    best, best_fraction = None, -1.0
+    for _ in range(max(max_tries, 1)):
+        xmin, ymin = randint(int(w / 2 - xoffset), slide_width - w), randint(int(h / 2 - yoffset), slide_height - h)
+        x, y = int(xmin - w / 2 + xoffset), int(ymin - h / 2 + yoffset)
+
+        if tissue_fraction is None or min_tissue <= 0:
+            return x, y
+
+        fraction = tissue_fraction(x, y, w, h)
+        if fraction >= min_tissue:
+            return x, y
+        if fraction > best_fraction:
+            best, best_fraction = (x, y), fraction
+
+    return best
+
+
+class WindowSampler:
+    """Seeded random windows that fully contain an annotation, drawn without rejection.
+
+    For every annotation, the window origins (x, y) that contain it, with the
+    same strict inequalities as `check_bbox`, form a rectangle of integers, and
+    so do those that also keep the window within `bounds` (left, top, right,
+    bottom). Both are computed once, so a draw picks an annotation, then an
+    origin in its rectangle: constant time, however sparse the annotations.
+
+    Annotations of `positive_classes` give the positive windows; the others,
+    e.g. the look-alikes of `negative_class` in `get_slides`, the hard
+    negatives. A hard negative window can still contain a positive annotation
+    nearby, which the slide's index reports as usual. Windows that contain
+    several annotations are drawn proportionally more often.
+    """
+
+    def __init__(self,
+                 bboxes: BoxArray,
+                 size: int,
+                 positive_classes: Sequence[int] = (2,),
+                 bounds: Optional[Tuple[int, int, int, int]] = None,
+                 seed: Optional[int] = None):
+
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+
+        left, top = bboxes.left.astype(np.int64), bboxes.top.astype(np.int64)
+        right, bottom = bboxes.right.astype(np.int64), bboxes.bottom.astype(np.int64)
+
+        # left > x and right < x + size, so right - size < x < left.
+        x_low, x_high = right - size + 1, left - 1
+        y_low, y_high = bottom - size + 1, top - 1
+        if bounds is not None:
+            bounds_left, bounds_top, bounds_right, bounds_bottom = bounds
+            x_low, x_high = np.maximum(x_low, bounds_left), np.minimum(x_high, bounds_right - size)
+            y_low, y_high = np.maximum(y_low, bounds_top), np.minimum(y_high, bounds_bottom - size)
+
+        # Annotations larger than the window, or too close to the bounds, have no
+        # valid origin and are never drawn.
+        usable = (x_low <= x_high) & (y_low <= y_high)
+        positive = np.isin(bboxes.labels, np.asarray(positive_classes))
+        order = np.flatnonzero(usable)
+        # Positives first, then hard negatives, each sorted by class, so that every
+        # group and every class within it is one contiguous run.
+        order = order[np.lexsort((bboxes.labels[order], ~positive[order]))]
+
+        self.labels = bboxes.labels[order]
+        self.low = np.stack([x_low[order], y_low[order]], axis=1)
+        self.high = np.stack([x_high[order], y_high[order]], axis=1)
+
+        positive_count = int(positive[order].sum())
+        self._groups = {}
+        for is_positive, offset, labels in ((True, 0, self.labels[:positive_count]),
+                                            (False, positive_count, self.labels[positive_count:])):
+            classes, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+            self._groups[is_positive] = (classes, starts + offset, counts)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def _draw(self, positive: bool, count: int, balanced: bool) -> np.ndarray:
+        classes, starts, counts = self._groups[positive]
+        if len(classes) == 0:
+            kind = 'positive' if positive else 'hard negative'
+            raise ValueError(f'No {kind} annotation fits in a {self.size} pixel window')
+
+        if balanced:
+            # Every class equally likely, whatever its number of annotations.
+            group = self.rng.integers(len(classes), size=count)
+            ids = starts[group] + self.rng.integers(counts[group])
+        else:
+            ids = starts[0] + self.rng.integers(counts.sum(), size=count)
+
+        return self.rng.integers(self.low[ids], self.high[ids] + 1)
+
+    def positives(self, count: int = 1, balanced: bool = True) -> np.ndarray:
+        # `count` window origins, as rows of (x, y).
+        return self._draw(True, count, balanced)
+
+    def hard_negatives(self, count: int = 1, balanced: bool = True) -> np.ndarray:
+        return self._draw(False, count, balanced)
+
+    @classmethod
+    def for_slide(cls,
+                  container: 'SlideContainer',
+                  size: Optional[int] = None,
+                  positive_class: int = 2,
+                  bounds: Optional[Tuple[int, int, int, int]] = None,
+                  seed: Optional[int] = None) -> 'WindowSampler':
+        # All the annotations of a slide from `get_slides`, in its coordinates.
+        bboxes = BoxArray.concatenate([entry['bboxes'] for entry in container.annotations.values()])
+        return cls(bboxes, container.width if size is None else size, (positive_class,), bounds, seed)
+
+
+def _load_slide_annotations(database: Database, slide_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    database.loadIntoMemory(slide_id)
+
+    x, y, agreed_classes = [], [], []
+    for id, annotation in database.annotations.items():
+
+        # Ignore deleted annotations, or any that are not of type SPOT.
+        if annotation.deleted or annotation.annotationType != AnnotationType.SPOT:
+            continue
+
+        x.append(annotation.x1)
+        y.append(annotation.y1)
+        agreed_classes.append(annotation.agreedClass)
+
+    return np.array(x, dtype=np.float64), np.array(y, dtype=np.float64), np.array(agreed_classes, dtype=np.int32)
+
 
 def get_slides(database: Database,
                test_slide_ids: List[int],
                base_path: str = 'WSI',
                size: int = 256,
                positive_class: int = 2,
-               negative_class: int = 7):
+               negative_class: int = 7,
+               annotation_table: Optional[AnnotationTable] = None,
+               radius: int = 25,
+               min_tissue: float = 0.0):
     
     lbl_bbox = []
     training_slides = []
@@ -103,15 +331,16 @@ def get_slides(database: Database,
     files = []
     
     slides = tqdm(
-        database.execute("SELECT uid, filename FROM Slides").fetchall(),
+        database.execute("SELECT uid, filename FROM Slides").fetchall() if annotation_table is None
+        else annotation_table.slides,
         desc='Loading slides...',
     )
 
     for idx, (cur_slide, filename) in enumerate(slides):
 
-        database.loadIntoMemory(cur_slide)
         slide_path = os.path.join(base_path, filename)
-        slide = openslide.open_slide(slide_path)
+        with instrumentation.timer('get_slides.slide_metadata'):
+            slide = slide_metadata(slide_path)
 
         level = 0
         level_dimension = slide.level_dimensions[level]
@@ -123,64 +352,61 @@ def get_slides(database: Database,
             positive_class: 1
         }
 
+        # Annotations come either from the bulk-loaded table, or from SlideRunner's
+        # per-slide in-memory representation.
+        with instrumentation.timer('get_slides.annotations'):
+            if annotation_table is None:
+                x, y, agreed_classes = _load_slide_annotations(database, cur_slide)
+            else:
+                spots = annotation_table.for_slide(cur_slide)
+                x, y, agreed_classes = spots.x, spots.y, spots.classes
+        instrumentation.count('get_slides.annotations', len(x))
+
+        d = 2 * radius / down_factor
+        x_min = (x - radius) / down_factor
+        y_min = (y - radius) / down_factor
+        x_max = x_min + d
+        y_max = y_min + d
+
+        # Sort all boxes of the slide by class once, so that the per-class entries
+        # in the annotation dictionary and the positive boxes are views into the
+        # same arrays instead of separate copies.
+        order = np.argsort(agreed_classes, kind='stable')
+        all_bboxes = BoxArray(x_min, y_min, x_max, y_max, agreed_classes)[order]
+        class_ids, starts, counts = np.unique(all_bboxes.labels, return_index=True, return_counts=True)
+
         annotations = {}
-        labels, bboxes = [], []
-        for id, annotation in database.annotations.items():
-
-            # Ignore deleted annotations, or any that are not of type SPOT.
-            if annotation.deleted or annotation.annotationType != AnnotationType.SPOT:
-                continue
-
-            annotation.r = 25
-            d = 2 * annotation.r / down_factor
-            x_min = (annotation.x1 - annotation.r) / down_factor
-            y_min = (annotation.y1 - annotation.r) / down_factor
-            x_max = x_min + d
-            y_max = y_min + d
-
-            # If the annotation class is not yet in the classes dictionary, create
-            # an entry and initialize the structures within.
-            if annotation.agreedClass not in annotations:
-                annotations[annotation.agreedClass] = {}
-                annotations[annotation.agreedClass]['bboxes'] = []
-                annotations[annotation.agreedClass]['label'] = []
-
-            # Store bounding box and label into the annotation dictionary.
-            annotations[annotation.agreedClass]['bboxes'].append([int(x_min), int(y_min), int(x_max), int(y_max)])
-            annotations[annotation.agreedClass]['label'].append(annotation.agreedClass)
-
-            # Store the bounding box and its label separately in the bboxes and labels
-            # lists.
-            if annotation.agreedClass in classes:
-                label = classes[annotation.agreedClass]
-
-                #                     bboxes.append([int(x_min), int(y_min), int(x_max), int(y_max)])
-                bboxes.append(BoundingBox(int(x_min), int(y_min), int(x_max), int(y_max)))
-                labels.append(label)
+        for class_id, start, count in zip(class_ids.tolist(), starts, counts):
+            annotations[class_id] = {
+                'bboxes': all_bboxes[start:start + count],
+                'label': all_bboxes.labels[start:start + count],
+            }
+
+        bboxes = annotations[positive_class]['bboxes'] if positive_class in annotations else BoxArray.empty()
+        labels = [classes[positive_class]] * len(bboxes)
 
         if len(bboxes) > 0:
             lbl_bbox.append([bboxes, labels])
+            index = GridIndex(bboxes.as_array(), cell_size=size)
             
+            container = SlideContainer(
+                file=slide_path,
+                annotations=annotations,
+                level=level,
+                width=size,
+                height=size,
+                y=[bboxes, labels],
+                index=index)
+            container.sample_func = partial(sampling_func,
+                                            negative_class=negative_class,
+                                            min_tissue=min_tissue,
+                                            tissue_fraction=container.tissue_fraction if min_tissue > 0 else None)
+            files.append(container)
+
             is_test = str(cur_slide) in test_slide_ids
             if is_test:
-                files.append(SlideContainer(
-                    file=slide_path,
-                    annotations=annotations,
-                    level=level,
-                    width=size,
-                    height=size,
-                    y=[bboxes, labels],
-                    sample_func=partial(sampling_func, negative_class=negative_class)))
                 test_slides.append(len(files) - 1)
             else:
-                files.append(SlideContainer(
-                    file=slide_path,
-                    annotations=annotations,
-                    level=level,
-                    width=size,
-                    height=size,
-                    y=[bboxes, labels],
-                    sample_func=partial(sampling_func, negative_class=negative_class)))
                 training_slides.append(len(files) - 1)
 
     return lbl_bbox, training_slides, test_slides, files
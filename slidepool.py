@@ -0,0 +1,54 @@
+from collections import OrderedDict
+import threading
+
+import openslide
+
+
+class SlideHandlePool:
+
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file) -> openslide.OpenSlide:
+        key = str(file)
+        with self._lock:
+            if key in self._handles:
+                self._handles.move_to_end(key)
+                return self._handles[key]
+
+        # Open outside the lock, so that a slow open does not block readers of
+        # slides that are already in the pool.
+        handle = openslide.open_slide(key)
+
+        with self._lock:
+            handle = self._handles.setdefault(key, handle)
+            self._handles.move_to_end(key)
+            self._evict()
+            return handle
+
+    def resize(self, maxsize: int) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._handles.clear()
+
+    def _evict(self) -> None:
+        # Evicted handles are not closed explicitly: a thread may still be reading
+        # from one, and OpenSlide closes the slide once the last reference is gone.
+        while len(self._handles) > self.maxsize:
+            self._handles.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+
+handle_pool = SlideHandlePool()
+
+
+def set_handle_pool_size(maxsize: int) -> None:
+    handle_pool.resize(maxsize)
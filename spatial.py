@@ -0,0 +1,79 @@
+from typing import Sequence
+
+import numpy as np
+
+
+class GridIndex:
+    """Uniform grid over axis-aligned boxes, stored as (left, top, right, bottom) rows."""
+
+    def __init__(self, boxes, cell_size: int = 512):
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.cell_size = cell_size
+
+        if len(self.boxes) == 0:
+            self.origin = np.zeros(2, dtype=np.int64)
+            self.grid_shape = (0, 0)
+            self._cell_ids = np.zeros(0, dtype=np.int64)
+            self._box_ids = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin = self.boxes[:, :2].min(axis=0)
+        c0 = (self.boxes[:, :2] - self.origin) // cell_size
+        c1 = (self.boxes[:, 2:] - self.origin) // cell_size
+        self.grid_shape = tuple(int(v) + 1 for v in c1.max(axis=0))
+
+        # Expand every box into the list of cells it touches. Annotations are much
+        # smaller than a cell, so this is usually one to four entries per box.
+        spans = c1 - c0 + 1
+        counts = spans[:, 0] * spans[:, 1]
+        box_ids = np.repeat(np.arange(len(self.boxes)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = c0[box_ids, 0] + local % spans[box_ids, 0]
+        cy = c0[box_ids, 1] + local // spans[box_ids, 0]
+        cell_ids = cy * self.grid_shape[0] + cx
+
+        order = np.argsort(cell_ids, kind='stable')
+        self._cell_ids = cell_ids[order]
+        self._box_ids = box_ids[order]
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def _candidates(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        if len(self.boxes) == 0:
+            return self._box_ids
+
+        nx, ny = self.grid_shape
+        cx0, cy0 = np.maximum((np.array([left, top]) - self.origin) // self.cell_size, 0)
+        cx1, cy1 = np.minimum((np.array([right, bottom]) - self.origin) // self.cell_size, [nx - 1, ny - 1])
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+
+        # Cells of one grid row are contiguous, so each row is a single range lookup.
+        rows = np.arange(cy0, cy1 + 1) * nx
+        starts = np.searchsorted(self._cell_ids, rows + cx0, side='left')
+        ends = np.searchsorted(self._cell_ids, rows + cx1, side='right')
+        if len(starts) == 1:
+            return np.unique(self._box_ids[starts[0]:ends[0]])
+
+        return np.unique(np.concatenate([self._box_ids[s:e] for s, e in zip(starts, ends)]))
+
+    def contained(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        # Same strict inequalities as the notebook's `check_bbox`.
+        ids = self._candidates(left, top, right, bottom)
+        b = self.boxes[ids]
+        mask = (b[:, 0] > left) & (b[:, 2] < right) & (b[:, 1] > top) & (b[:, 3] < bottom)
+        return ids[mask]
+
+    def intersecting(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        ids = self._candidates(left, top, right, bottom)
+        b = self.boxes[ids]
+        mask = (b[:, 0] < right) & (b[:, 2] > left) & (b[:, 1] < bottom) & (b[:, 3] > top)
+        return ids[mask]
+
+    def contained_in_window(self, x: int, y: int, size: int) -> np.ndarray:
+        return self.contained(x, y, x + size, y + size)
+
+    @classmethod
+    def from_bboxes(cls, bboxes: Sequence, cell_size: int = 512) -> 'GridIndex':
+        return cls([[b.left, b.top, b.right, b.bottom] for b in bboxes], cell_size=cell_size)
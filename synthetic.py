@@ -0,0 +1,196 @@
+import os
+import sqlite3
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from annotation_loader import SPOT_ANNOTATION_TYPE
+
+
+class SyntheticSlide:
+    """Procedural slide: an elliptical patch of "tissue" on glass, with dark round figures at given centers."""
+
+    def __init__(self, width: int, height: int, centers: np.ndarray, radius: int = 25, seed: int = 0):
+        self.width = width
+        self.height = height
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        self.radius = radius
+        self.seed = seed
+
+    def tile(self, x: int, y: int, width: int, height: int, downsample: float = 1.0) -> np.ndarray:
+        # Level-0 coordinates of the pixel centers of this tile.
+        xs = (x + np.arange(width) + 0.5) * downsample
+        ys = (y + np.arange(height) + 0.5) * downsample
+
+        cx, cy = self.width / 2, self.height / 2
+        tissue = (((xs[None, :] - cx) / (0.4 * self.width)) ** 2 + ((ys[:, None] - cy) / (0.4 * self.height)) ** 2) <= 1
+
+        rng = np.random.default_rng((self.seed, x, y, int(downsample)))
+        tile = np.full((height, width, 3), 242, dtype=np.uint8)
+        noise = rng.integers(-12, 12, size=(height, width, 1))
+        tile[tissue] = np.clip(np.array([214, 140, 190]) + noise[tissue], 0, 255)
+
+        # Only the figures that can touch this tile.
+        x0, y0 = x * downsample - self.radius, y * downsample - self.radius
+        x1, y1 = (x + width) * downsample + self.radius, (y + height) * downsample + self.radius
+        near = self.centers[(self.centers[:, 0] >= x0) & (self.centers[:, 0] < x1) &
+                            (self.centers[:, 1] >= y0) & (self.centers[:, 1] < y1)]
+        for fx, fy in near:
+            figure = (xs[None, :] - fx) ** 2 + (ys[:, None] - fy) ** 2 <= (self.radius * 0.6) ** 2
+            tile[figure] = (70, 30, 90)
+
+        return tile
+
+    def write_tiff(self, path: str, tile_size: int = 256, levels: int = 3, level_factor: int = 4) -> str:
+        # A tiled TIFF with one page per pyramid level, the lower levels marked
+        # as reduced-resolution images, which OpenSlide opens with its generic
+        # TIFF driver.
+        import tifffile
+
+        with tifffile.TiffWriter(path, bigtiff=True) as tif:
+            for level in range(levels):
+                downsample = level_factor ** level
+                width, height = self.width // downsample, self.height // downsample
+
+                def tiles(downsample=downsample, width=width, height=height):
+                    for ty in range(0, height, tile_size):
+                        for tx in range(0, width, tile_size):
+                            yield self.tile(tx, ty, tile_size, tile_size, downsample)
+
+                tif.write(tiles(),
+                          shape=(height, width, 3),
+                          dtype=np.uint8,
+                          tile=(tile_size, tile_size),
+                          photometric='rgb',
+                          compression='zlib',
+                          subfiletype=0 if level == 0 else 1,
+                          metadata=None)
+
+        return path
+
+
+def random_centers(width: int, height: int, count: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    # Keep figures inside the tissue ellipse, where real annotations are.
+    angle = rng.uniform(0, 2 * np.pi, count)
+    distance = np.sqrt(rng.uniform(0, 1, count)) * 0.38
+    return np.stack([width / 2 + np.cos(angle) * distance * width,
+                     height / 2 + np.sin(angle) * distance * height], axis=1)
+
+
+def write_sliderunner_database(path: str,
+                               slides: List[Tuple[str, int, int, np.ndarray, np.ndarray]],
+                               deleted_fraction: float = 0.05,
+                               seed: int = 0) -> str:
+
+    # `slides` holds (filename, width, height, centers, classes) per slide.
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE Slides (uid INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, width INTEGER, height INTEGER,
+                             directory TEXT, uuid TEXT, exactImageID TEXT);
+        CREATE TABLE Classes (uid INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, color TEXT);
+        CREATE TABLE Persons (uid INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, isExactUser INTEGER DEFAULT 0);
+        CREATE TABLE Annotations (uid INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT, lastModified REAL DEFAULT 0,
+                                  deleted INTEGER DEFAULT 0, slide INTEGER, type INTEGER, agreedClass INTEGER,
+                                  description TEXT, clickable INTEGER DEFAULT 1);
+        CREATE TABLE Annotations_coordinates (uid INTEGER PRIMARY KEY AUTOINCREMENT, coordinateX INTEGER,
+                                              coordinateY INTEGER, coordinateZ INTEGER DEFAULT 0, slide INTEGER,
+                                              annoId INTEGER, orderIdx INTEGER);
+        CREATE TABLE Annotations_label (uid INTEGER PRIMARY KEY AUTOINCREMENT, person INTEGER, class INTEGER,
+                                        annoId INTEGER, exact_id INTEGER);
+        CREATE INDEX annoId_index ON Annotations_coordinates (annoId);
+        INSERT INTO Classes (uid, name) VALUES (1, 'Mitotic figure lookalike'), (2, 'Mitotic figure');
+        INSERT INTO Persons (uid, name) VALUES (1, 'synthetic');
+    ''')
+
+    annotation_id = 0
+    for slide_id, (filename, width, height, centers, classes) in enumerate(slides, start=1):
+        connection.execute('INSERT INTO Slides (uid, filename, width, height) VALUES (?, ?, ?, ?)',
+                           (slide_id, filename, width, height))
+
+        ids = np.arange(annotation_id + 1, annotation_id + len(centers) + 1)
+        annotation_id += len(centers)
+        deleted = rng.uniform(size=len(centers)) < deleted_fraction
+
+        connection.executemany(
+            'INSERT INTO Annotations (uid, guid, deleted, slide, type, agreedClass) VALUES (?, ?, ?, ?, ?, ?)',
+            [(int(i), f'synthetic-{i}', int(d), slide_id, SPOT_ANNOTATION_TYPE, int(c))
+             for i, d, c in zip(ids, deleted, classes)])
+        connection.executemany(
+            'INSERT INTO Annotations_coordinates (coordinateX, coordinateY, slide, annoId, orderIdx) '
+            'VALUES (?, ?, ?, ?, 1)',
+            [(int(x), int(y), slide_id, int(i)) for i, (x, y) in zip(ids, centers)])
+        connection.executemany(
+            'INSERT INTO Annotations_label (person, class, annoId) VALUES (1, ?, ?)',
+            [(int(c), int(i)) for i, c in zip(ids, classes)])
+
+    connection.commit()
+    connection.close()
+
+    return path
+
+
+def dark_spot_detector(tile: np.ndarray, threshold: int = 110, name: str = 'mitotic figure') -> List[Dict[str, Any]]:
+    # Stub model for synthetic slides: one detection per connected run of dark
+    # pixels, approximated by the bounding box of dark rows and columns.
+    dark = tile.mean(axis=2) < threshold
+    if not dark.any():
+        return []
+
+    height, width = dark.shape
+    labels = []
+    for rows in _runs(dark.any(axis=1)):
+        for cols in _runs(dark[rows[0]:rows[1]].any(axis=0)):
+            labels.append({
+                'Name': name,
+                'Confidence': 90.0,
+                'Geometry': {'BoundingBox': {
+                    'Left': cols[0] / width,
+                    'Top': rows[0] / height,
+                    'Width': (cols[1] - cols[0]) / width,
+                    'Height': (rows[1] - rows[0]) / height,
+                }},
+            })
+
+    return labels
+
+
+def _runs(values: np.ndarray) -> List[Tuple[int, int]]:
+    padded = np.concatenate([[False], values, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def make_dataset(directory: str,
+                 slide_count: int = 2,
+                 width: int = 8192,
+                 height: int = 8192,
+                 annotations_per_slide: int = 500,
+                 positive_fraction: float = 0.3,
+                 seed: int = 0,
+                 write_slides: bool = True) -> Tuple[str, List[str]]:
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    slides, paths = [], []
+    for i in range(slide_count):
+        filename = f'synthetic_{i}.tiff'
+        centers = random_centers(width, height, annotations_per_slide, seed=seed + i)
+        # Class 2 is the positive class, as in MITOS_WSI_CMC.
+        classes = np.where(rng.uniform(size=annotations_per_slide) < positive_fraction, 2, 1)
+
+        path = os.path.join(directory, filename)
+        if write_slides and not os.path.exists(path):
+            SyntheticSlide(width, height, centers, seed=seed + i).write_tiff(path)
+
+        slides.append((filename, width, height, centers, classes))
+        paths.append(path)
+
+    database = write_sliderunner_database(os.path.join(directory, 'synthetic.sqlite'), slides, seed=seed)
+
+    return database, paths
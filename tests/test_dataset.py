@@ -0,0 +1,110 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from dataset import DownloadError, download_file
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Serves `CONTENT` at every path, honouring `Range: bytes=<start>-`. The
+    # first response to a path listed in `server.cut` stops halfway through.
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        else:
+            self.send_response(200)
+
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.path in self.server.cut:
+            self.server.cut.remove(self.path)
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.requests = []
+    httpd.cut = set()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, path: str) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+def test_truncated_transfer_is_resumed(server, tmp_path):
+    server.cut.add('/slide.svs')
+    path = str(tmp_path / 'slide.svs')
+
+    downloaded = download_file(_url(server, '/slide.svs'), path, sha256=hashlib.sha256(CONTENT).hexdigest(),
+                               retry_delay=0)
+
+    assert open(path, 'rb').read() == CONTENT
+    assert downloaded == len(CONTENT)
+    assert not os.path.exists(path + '.part')
+    assert server.requests == [('/slide.svs', None), ('/slide.svs', f'bytes={len(CONTENT) // 2}-')]
+
+
+def test_complete_part_file_is_finalized_on_416(server, tmp_path):
+    path = str(tmp_path / 'slide.svs')
+    with open(path + '.part', 'wb') as f:
+        f.write(CONTENT)
+
+    downloaded = download_file(_url(server, '/slide.svs'), path, retry_delay=0)
+
+    assert downloaded == 0
+    assert open(path, 'rb').read() == CONTENT
+    assert server.requests == [('/slide.svs', f'bytes={len(CONTENT)}-')]
+
+
+def test_checksum_mismatch_is_an_error(server, tmp_path):
+    path = str(tmp_path / 'slide.svs')
+
+    with pytest.raises(DownloadError, match='SHA256 mismatch'):
+        download_file(_url(server, '/slide.svs'), path, sha256='0' * 64, retry_delay=0)
+
+    # Neither the bad file nor its partial download is kept.
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def test_complete_file_is_skipped(server, tmp_path):
+    path = tmp_path / 'slide.svs'
+    path.write_bytes(CONTENT)
+
+    downloaded = download_file(_url(server, '/slide.svs'), str(path), sha256=hashlib.sha256(CONTENT).hexdigest())
+
+    assert downloaded == 0
+    assert server.requests == []
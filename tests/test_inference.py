@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from inference import Detection, detect_slide, enumerate_tiles, merge_detections
+
+
+def _reference_merge(detections, overlap_threshold=0.5):
+    # Greedy NMS comparing every pair, as merge_detections did before it only
+    # looked at intersecting boxes.
+    order = sorted(range(len(detections)), key=lambda i: -detections[i].confidence)
+    keep = []
+    for i in order:
+        a = detections[i]
+        suppressed = False
+        for k in keep:
+            b = detections[k]
+            iw = max(0.0, min(a.right, b.right) - max(a.left, b.left))
+            ih = max(0.0, min(a.bottom, b.bottom) - max(a.top, b.top))
+            smaller = min((a.right - a.left) * (a.bottom - a.top), (b.right - b.left) * (b.bottom - b.top))
+            if a.label == b.label and iw * ih / max(smaller, 1e-9) >= overlap_threshold:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(i)
+    return [detections[i] for i in keep]
+
+
+def test_merge_keeps_most_confident_duplicate():
+    detections = [
+        Detection(100, 100, 150, 150, 'mitotic figure', 80.0),
+        Detection(102, 101, 151, 149, 'mitotic figure', 95.0),
+        Detection(400, 400, 450, 450, 'mitotic figure', 60.0),
+    ]
+
+    assert merge_detections(detections) == [detections[1], detections[2]]
+
+
+def test_merge_suppresses_box_cut_by_tile_border():
+    # The partial box is mostly inside the full one, although their IoU is low.
+    full = Detection(500, 100, 560, 160, 'mitotic figure', 90.0)
+    partial = Detection(500, 100, 512, 160, 'mitotic figure', 70.0)
+
+    assert merge_detections([partial, full]) == [full]
+
+
+def test_merge_keeps_overlapping_boxes_of_other_labels():
+    detections = [
+        Detection(100, 100, 150, 150, 'mitotic figure', 90.0),
+        Detection(100, 100, 150, 150, 'look-alike', 80.0),
+    ]
+
+    assert merge_detections(detections) == detections
+
+
+def test_merge_empty():
+    assert merge_detections([]) == []
+
+
+def test_merge_matches_pairwise_reference():
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(0, 2000, size=(1500, 2))
+    sizes = rng.uniform(10, 80, size=(1500, 2))
+    detections = [Detection(float(x), float(y), float(x + w), float(y + h),
+                            str(rng.integers(2)), float(rng.integers(100)))
+                  for (x, y), (w, h) in zip(corners, sizes)]
+
+    assert merge_detections(detections) == _reference_merge(detections)
+
+
+def test_enumerate_tiles_covers_slide():
+    tiles = enumerate_tiles(1200, 700, tile_size=512, overlap=64)
+
+    assert tiles[0] == (0, 0)
+    assert max(x for x, _ in tiles) + 512 == 1200
+    assert max(y for _, y in tiles) + 512 == 700
+
+
+class RecordingClient:
+
+    def __init__(self):
+        self.requests = []
+
+    def detect_custom_labels(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'CustomLabels': []}
+
+
+def _blank_slide(width: int = 1000, height: int = 1000):
+    return SimpleNamespace(level=0,
+                           down_factor=1.0,
+                           metadata=SimpleNamespace(level_dimensions=[(width, height)]),
+                           get_patch=lambda x, y, width, height: np.zeros((height, width, 3), dtype=np.uint8))
+
+
+def test_min_confidence_is_only_sent_when_set():
+    client = RecordingClient()
+    detect_slide(_blank_slide(), client, 'arn', max_workers=2)
+
+    # Rekognition then applies each label's own threshold.
+    assert client.requests
+    assert all('MinConfidence' not in request for request in client.requests)
+
+    client = RecordingClient()
+    detect_slide(_blank_slide(), client, 'arn', max_workers=2, min_confidence=40.0)
+
+    assert all(request['MinConfidence'] == 40.0 for request in client.requests)
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+import pytest
+
+from rekognition_client import AIMDLimiter, FakeThrottlingClient, RekognitionClient
+
+
+def test_burst_of_throttles_decreases_once():
+    limiter = AIMDLimiter(initial=8, window=0)
+    started = [limiter.acquire() for _ in range(8)]
+
+    # Every call of the burst was in flight before the first decrease.
+    for token in started:
+        limiter.release(True, token)
+
+    assert limiter.limit == 4
+    assert limiter.decreases == 1
+
+
+def test_decreases_at_most_once_per_window():
+    limiter = AIMDLimiter(initial=16, window=60)
+    limiter.release(True, limiter.acquire())
+    limiter.release(True, limiter.acquire())
+
+    assert limiter.limit == 8
+
+
+def test_growth_after_throttling_is_one_per_window():
+    limiter = AIMDLimiter(initial=8, window=60)
+    limiter.release(True, limiter.acquire())
+    for _ in range(20):
+        limiter.release(False, limiter.acquire())
+
+    assert limiter.limit == 4
+
+
+def test_server_errors_are_retried_without_changing_the_limit():
+    class FlakyClient:
+        calls = 0
+
+        def detect_custom_labels(self, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                raise ClientError({'Error': {'Code': 'InternalServerError'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 500}}, 'DetectCustomLabels')
+            if self.calls == 2:
+                raise ReadTimeoutError(endpoint_url='https://rekognition.us-east-1.amazonaws.com')
+            return {'CustomLabels': []}
+
+    client = RekognitionClient(client=FlakyClient(), base_delay=0.001)
+    limit = client.limiter.limit
+
+    assert client.detect_custom_labels(ProjectVersionArn='arn') == {'CustomLabels': []}
+    assert client.stats['retries'] == 2
+    assert client.stats['throttles'] == 0
+    # Only the final success counts towards growth; retries feed nothing back.
+    assert client.limiter.decreases == 0
+    assert client.limiter.limit == pytest.approx(limit + 1 / limit)
+
+
+def test_other_errors_are_not_retried():
+    class DeniedClient:
+        def detect_custom_labels(self, **kwargs):
+            raise ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'DetectCustomLabels')
+
+    client = RekognitionClient(client=DeniedClient())
+    with pytest.raises(ClientError):
+        client.detect_custom_labels(ProjectVersionArn='arn')
+    assert client.stats['calls'] == 1
+
+
+def test_concurrency_converges_below_throttling_rate():
+    rate, calls = 20, 200
+    client = RekognitionClient(client=FakeThrottlingClient(rate=rate, latency=0.05), max_retries=50)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(lambda _: client.detect_custom_labels(ProjectVersionArn='arn'), range(calls)))
+    throughput = calls / (time.monotonic() - start)
+
+    # Most of the allowed rate is used, without throttling most calls.
+    assert throughput >= 0.75 * rate
+    assert client.stats['throttles'] < 0.75 * calls
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from s3sync import MB, etag, sync_directory
+
+BUCKET = 'rek-wsi-test'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _write(path, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_sync_skips_objects_with_matching_etag(s3, tmp_path):
+    _write(tmp_path / 'WSI' / 'a.svs', b'a' * 1000)
+    _write(tmp_path / 'WSI' / 'b.svs', b'b' * 2000)
+
+    first = sync_directory(str(tmp_path), BUCKET, prefix='data', client=s3, max_workers=2)
+    assert (first.uploaded, first.skipped, first.uploaded_bytes) == (2, 0, 3000)
+
+    second = sync_directory(str(tmp_path), BUCKET, prefix='data', client=s3, max_workers=2)
+    assert (second.uploaded, second.skipped) == (0, 2)
+
+    # Same size, other contents: the ETag differs, so the file is uploaded again.
+    _write(tmp_path / 'WSI' / 'a.svs', b'c' * 1000)
+    third = sync_directory(str(tmp_path), BUCKET, prefix='data', client=s3, max_workers=2)
+    assert (third.uploaded, third.skipped) == (1, 1)
+    assert s3.get_object(Bucket=BUCKET, Key='data/WSI/a.svs')['Body'].read() == b'c' * 1000
+
+
+def test_multipart_etag_matches_s3(s3, tmp_path):
+    path = tmp_path / 'large.svs'
+    _write(path, os.urandom(11 * MB))
+
+    options = dict(multipart_threshold=5 * MB, multipart_chunksize=5 * MB)
+    first = sync_directory(str(tmp_path), BUCKET, prefix='', client=s3, max_workers=1, **options)
+    assert first.uploaded == 1
+
+    remote = s3.head_object(Bucket=BUCKET, Key='large.svs')['ETag'].strip('"')
+    assert remote == etag(str(path), 5 * MB, 5 * MB)
+    assert remote.endswith('-3')
+
+    second = sync_directory(str(tmp_path), BUCKET, prefix='', client=s3, max_workers=1, **options)
+    assert (second.uploaded, second.skipped) == (0, 1)
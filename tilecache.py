@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import threading
+from typing import Dict
+
+import numpy as np
+
+import instrumentation
+
+
+class TileCache:
+    """LRU cache of decoded, tile-aligned RGBA blocks shared by all slides, bounded in bytes."""
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, tile_size: int = 512):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes and self._blocks:
+            _, block = self._blocks.popitem(last=False)
+            self.bytes -= block.nbytes
+
+    def resize(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+
+    def _block(self, slide, key: str, level: int, tx: int, ty: int) -> np.ndarray:
+        block_key = (key, level, tx, ty)
+        with self._lock:
+            block = self._blocks.get(block_key)
+            if block is not None:
+                self._blocks.move_to_end(block_key)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        # Decode outside the lock; two threads missing on the same block at once
+        # both decode it, which is cheaper than serializing every read.
+        downsample = slide.level_downsamples[level]
+        size = self.tile_size
+        with instrumentation.timer('slide.decode'):
+            block = np.asarray(slide.read_region(location=(int(tx * size * downsample), int(ty * size * downsample)),
+                                                 level=level, size=(size, size)))
+
+        with self._lock:
+            if block_key not in self._blocks:
+                self._blocks[block_key] = block
+                self.bytes += block.nbytes
+                self._evict()
+
+        return block
+
+    def read_region(self, slide, key: str, level: int, x: int, y: int, width: int, height: int) -> np.ndarray:
+        # `x` and `y` are in the coordinates of `level`; the result is RGBA, like
+        # OpenSlide's read_region.
+        size = self.tile_size
+        out = np.empty((height, width, 4), dtype=np.uint8)
+
+        for ty in range(y // size, (y + height - 1) // size + 1):
+            for tx in range(x // size, (x + width - 1) // size + 1):
+                block = self._block(slide, key, level, tx, ty)
+
+                # Intersection of the window and the block, in level coordinates.
+                x0, y0 = max(x, tx * size), max(y, ty * size)
+                x1, y1 = min(x + width, (tx + 1) * size), min(y + height, (ty + 1) * size)
+                out[y0 - y:y1 - y, x0 - x:x1 - x] = block[y0 - ty * size:y1 - ty * size, x0 - tx * size:x1 - tx * size]
+
+        return out
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'blocks': len(self._blocks),
+            'bytes': self.bytes,
+        }
@@ -0,0 +1,121 @@
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+
+
+class TissueMask:
+    """Boolean tissue mask of a slide, with fast tissue fraction queries in level-0 coordinates."""
+
+    def __init__(self, mask: np.ndarray, downsample_x: float, downsample_y: float):
+        self.mask = mask.astype(bool)
+        self.downsample_x = downsample_x
+        self.downsample_y = downsample_y
+
+        # Summed-area table with a leading row and column of zeros, so the sum
+        # over any window is four lookups. Counts never exceed the number of mask
+        # pixels, so int32 is enough for any thumbnail-sized mask and halves the
+        # memory held per slide.
+        dtype = np.int32 if self.mask.size < 2 ** 31 else np.int64
+        self._integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=dtype)
+        self._integral[1:, 1:] = self.mask.cumsum(axis=0, dtype=dtype).cumsum(axis=1, dtype=dtype)
+
+    def fractions(self, x, y, width, height) -> np.ndarray:
+        rows, cols = self.mask.shape
+        x0 = np.clip(np.floor(np.asarray(x) / self.downsample_x).astype(np.int64), 0, cols)
+        y0 = np.clip(np.floor(np.asarray(y) / self.downsample_y).astype(np.int64), 0, rows)
+        x1 = np.clip(np.ceil((np.asarray(x) + width) / self.downsample_x).astype(np.int64), 0, cols)
+        y1 = np.clip(np.ceil((np.asarray(y) + height) / self.downsample_y).astype(np.int64), 0, rows)
+
+        s = self._integral
+        tissue = s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0]
+        area = (x1 - x0) * (y1 - y0)
+
+        return np.where(area > 0, tissue / np.maximum(area, 1), 0.0)
+
+    def fraction(self, x: float, y: float, width: float, height: float) -> float:
+        return float(self.fractions(x, y, width, height))
+
+    def save(self, path: str) -> None:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, mask=self.mask, downsample=[self.downsample_x, self.downsample_y])
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TissueMask':
+        with np.load(path) as data:
+            return cls(data['mask'], *data['downsample'].tolist())
+
+
+def otsu_threshold(values: np.ndarray) -> float:
+    histogram = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    bins = np.arange(256)
+
+    weight_background = np.cumsum(histogram)
+    weight_foreground = weight_background[-1] - weight_background
+    sum_background = np.cumsum(histogram * bins)
+    mean_background = sum_background / np.maximum(weight_background, 1)
+    mean_foreground = (sum_background[-1] - sum_background) / np.maximum(weight_foreground, 1)
+
+    between_class_variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+    return float(np.argmax(between_class_variance))
+
+
+def _shift_reduce(mask: np.ndarray, radius: int, reduce) -> np.ndarray:
+    # Square structuring element, applied separably along each axis.
+    for axis in (0, 1):
+        padded = np.pad(mask, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)], mode='edge')
+        length = mask.shape[axis]
+        mask = reduce([np.take(padded, range(i, i + length), axis=axis) for i in range(2 * radius + 1)])
+    return mask
+
+
+def dilate(mask: np.ndarray, radius: int) -> np.ndarray:
+    return _shift_reduce(mask, radius, lambda shifted: np.logical_or.reduce(shifted))
+
+
+def erode(mask: np.ndarray, radius: int) -> np.ndarray:
+    return _shift_reduce(mask, radius, lambda shifted: np.logical_and.reduce(shifted))
+
+
+def compute_tissue_mask(slide, max_size: int = 2048, min_saturation: int = 20, radius: int = 2) -> TissueMask:
+    # The thumbnail is rendered from the lowest-resolution level that is large
+    # enough, so this never decodes level 0.
+    thumbnail = slide.get_thumbnail((max_size, max_size)).convert('RGB')
+    saturation = np.asarray(thumbnail.convert('HSV'))[:, :, 1]
+
+    # Stained tissue is saturated, while glass and background are grey or white.
+    threshold = max(otsu_threshold(saturation), min_saturation)
+    mask = saturation > threshold
+
+    # Closing fills small holes inside tissue, opening removes dust and specks.
+    mask = erode(dilate(mask, radius), radius)
+    mask = dilate(erode(mask, radius), radius)
+
+    width, height = slide.dimensions
+    return TissueMask(mask, width / mask.shape[1], height / mask.shape[0])
+
+
+def cached_tissue_mask(slide,
+                       file: str,
+                       cache_dir: Optional[str] = None,
+                       max_size: int = 2048,
+                       min_saturation: int = 20,
+                       radius: int = 2) -> TissueMask:
+    cache_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Keyed by the full path and the mask parameters, so that slides with the
+        # same name in different directories, or other settings, get their own.
+        key = hashlib.sha256(f'{os.path.abspath(file)}:{max_size}:{min_saturation}:{radius}'.encode('utf-8'))
+        cache_path = os.path.join(cache_dir, f'{os.path.basename(file)}.{key.hexdigest()[:16]}.tissue.npz')
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file):
+            return TissueMask.load(cache_path)
+
+    mask = compute_tissue_mask(slide, max_size=max_size, min_saturation=min_saturation, radius=radius)
+    if cache_path is not None:
+        mask.save(cache_path)
+
+    return mask